@@ -1,11 +1,14 @@
 import os
-import glob
 import sys
+import logging
 import importlib
 import enum
+import threading
+import time
+import traceback
 import warnings
-from collections import deque
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from inspect import signature
 from tkinter import Tk, filedialog
 
@@ -13,7 +16,15 @@ import h5py
 import scipy.ndimage as ndi
 import numpy as np
 from scipy.optimize import least_squares
-from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal
+from PyQt5.QtCore import Qt, QObject, QThread, pyqtSignal
+
+from framebuffer import FrameBuffer
+from latencystats import LatencyStats
+from logwriter import LogWriter
+from eventstore import EventStore
+from stackwriter import StackWriter
+from pipelineprocess import PipelineProcess, basePipelineName
+from roicrop import MaskCrop
 
 warnings.filterwarnings("ignore")
 
@@ -54,9 +65,17 @@ class EtSTEDController():
         # create a helper controller for the coordinate transform pop-out widget
         self.__coordTransformHelper = EtSTEDCoordTransformHelper(self, self._widget.coordTransformWidget, _logsDir)
 
+        # background writer for event logs and pipeline messages
+        self.logWriter = LogWriter(_logsDir)
+        # store of the detected events of a session, written in the background
+        self.eventStore = EventStore(self.logWriter)
+
+        # rolling statistics of the durations of the frame-to-scan stages
+        self.latencyStats = LatencyStats()
+
         # add camera image to napariviewer
         self.camImageLayer = self._widget.imageViewer.add_image(self.camera.getImage())
-        # update camera image automatically (mock)
+        # update camera image automatically on every new frame pushed from the camera (mock)
         # real use-case: use detector manager and image updated signals of software where implemented
         self.camImgThread = QThread()
         self.camImgWorker = CameraImageWorker(self, camera)
@@ -64,12 +83,27 @@ class EtSTEDController():
         self.camImgThread.started.connect(self.camImgWorker.run)
         self.camImgThread.start()
 
+        # run the analysis pipeline in a separate thread, always on the latest frame only
+        self.analysisThread = QThread()
+        self.analysisWorker = AnalysisWorker(self)
+        self.analysisWorker.moveToThread(self.analysisThread)
+        self.analysisThread.started.connect(self.analysisWorker.run)
+        self.analysisThread.start()
+        # let a camera pacing its frames by the analysis (replay camera) know when a frame has been analysed
+        if hasattr(self.camera, 'frameAnalysed'):
+            self.analysisWorker.frameAnalysed.connect(self.camera.frameAnalysed, Qt.DirectConnection)
+        # update the widget and pause or continue the fast method in the GUI thread, on requests from the analysis thread
+        self.analysisWorker.coordsDetected.connect(self.updateScatter)
+        self.analysisWorker.analysisImage.connect(self.setAnalysisHelpImg)
+        self.analysisWorker.pauseRequested.connect(self.pauseFastModality)
+        self.analysisWorker.continueRequested.connect(self.continueFastModality)
+
         # Connect EtSTEDWidget and communication channel signals
         self._widget.initiateButton.clicked.connect(self.initiate)
         self._widget.loadPipelineButton.clicked.connect(self.loadPipeline)
         self._widget.recordBinaryMaskButton.clicked.connect(self.initiateBinaryMask)
         self._widget.loadScanParametersButton.clicked.connect(self.getScanParameters)
-        self._widget.setBusyFalseButton.clicked.connect(self.setBusyFalse)
+        self._widget.setBusyFalseButton.clicked.connect(self.unlockSoftlock)
 
         # initiate log for each detected event
         self.resetDetLog()
@@ -77,25 +111,39 @@ class EtSTEDController():
         self.getScanParameters()  # mock: to avoid having to manually press the button
         # initiate other parameters and flags used during experiments
         self.initiateFlagsParams()
+        # background writer for the frames leading up to detected events
+        self.stackWriter = StackWriter(self.__prevFrames.capacity, compression=self.__save_compression)
 
     def initiateFlagsParams(self):
         # initiate flags and params
         self.__running = False  # run flag
         self.__runMode = RunMode.Experiment  # run mode currently used
         self.__validating = False  # validation flag
-        self.__busy = False  # running pipeline busy flag
-        self.__prevFrames = deque(maxlen=10)  # deque for previous fast frames
-        self.__prevAnaFrames = deque(maxlen=10)  # deque for previous preprocessed analysis frames
+        self.pipeline = None  # analysis pipeline, set when loading a pipeline
+        self.__prevFrames = FrameBuffer(10)  # ring buffer for previous fast frames, with their summed-area tables if used by the pipeline
+        self.__prevAnaFrames = FrameBuffer(10)  # ring buffer for previous preprocessed analysis frames
+        self.__pipelineProcess = None  # worker process running the pipeline, if running in process mode
         self.__binary_mask = None  # binary mask of regions of interest, used by certain pipelines, leave None to consider the whole image
-        self.__binary_frames = 10  # number of frames to use for calculating binary mask 
+        self.__binary_frames = 10  # number of frames to use for calculating binary mask, averaged in constant memory so can be hundreds
+        self.__binary_sum = None  # running sum of the frames recorded for the binary mask
+        self.__binary_count = 0  # number of frames in the running sum
+        self.__binary_refreshing = False  # binary mask refresh flag, recalculating the mask in the background during experiments
+        self.__binaryMaskExecutor = ThreadPoolExecutor(max_workers=1)  # background thread for refreshing the binary mask
+        self.__crop_to_mask = True  # crop the frames passed to the pipeline to the bounding box of the binary mask
+        self.__crop_margin = 48  # margin (px) around the binary mask bounding box, covering the filter halos of the pipelines
+        self.__mask_crop = None  # crop to the binary mask bounding box currently used, None if running on whole frames
         self.__init_frames = 5  # number of frames after initiating etSTED before a trigger can occur, to allow laser power settling etc
         self.__validation_frames = 5  # number of fast frames to record after detecting an event in validation mode
-        self.t_call = 0
+        self.__save_compression = None  # compression of saved event frames, 'gzip', 'lzf' or None
+        self.__t_lastcall = None  # start timestamp (ns) of the last pipeline run
         self.__params_exclude = ['img', 'prev_frames', 'binary_mask', 'exinfo', 'testmode']  # excluded pipeline parameters when loading param fields
 
     def initiate(self):
         """ Initiate or stop an etSTED experiment. """
         if not self.__running:
+            if self.pipeline is None:
+                print('Load an analysis pipeline before initiating etSTED.')
+                return
             # detector and laser for fast imaging
             detectorFastIdx = self._widget.fastImgDetectorsPar.currentIndex()
             self.detectorFast = self._widget.fastImgDetectors[detectorFastIdx]
@@ -108,6 +156,26 @@ class EtSTEDController():
             self.resetRunParams()
             # Reset parameter for extra information that pipelines can input and output
             self.__exinfo = None
+            # crop the frames passed to the pipeline to the binary mask, if chosen
+            self.__crop_to_mask = self._widget.cropMaskCheck.isChecked()
+            self.__mask_crop = None
+            # start, reset or stop the worker process for running the pipeline in a separate process
+            self.setPipelineProcess(self._widget.processModeCheck.isChecked())
+            # reset frame counters, used for counting dropped frames
+            self.camImgWorker.resetFrameCounters()
+            self.analysisWorker.resetFrameCounters()
+            if hasattr(self.camera, 'resetFrameCounters'):
+                self.camera.resetFrameCounters()
+            # start a new log session and event store, and reset latency statistics
+            self.logWriter.newSession()
+            self.eventStore.newSession(self.logWriter.newName('events') + '.h5', self.pipeline.__name__,
+                                       self.getPipelineParamNames(), self.__param_vals)
+            # save the frames of each event, and stream every frame to the file, if chosen
+            self.stackWriter.newSession(self.logWriter.newName('frames') + '.h5', self._widget.streamFramesCheck.isChecked())
+            self.latencyStats.reset()
+            self.__t_lastcall = None
+            # start refreshing the binary mask in the background, if chosen
+            self.setBinaryMaskRefresh(self._widget.binaryRefreshCheck.isChecked())
 
             # launch help widget, if visualization mode or validation mode
             # Check if visualization mode, in case launch help widget
@@ -127,7 +195,8 @@ class EtSTEDController():
             self.__transformCoeffs = self.__coordTransformHelper.getTransformCoeffs()
             # connect signals and turn on wf laser
             # connect signal from update of image to running pipeline #xxx.sigUpdateImage.connect(self.runPipeline)
-            self.camImgWorker.newFrame.connect(self.runPipeline)  # mock: directly from mock camera worker
+            self.camImgWorker.newFrame.connect(self.analysisWorker.putFrame, Qt.DirectConnection)  # mock: directly from mock camera worker
+            self.analysisWorker.resume()
             # connect signal from end of scan to scanEnded() #xxx.sigScanEnded.connect(self.scanEnded)
             # turn on laserFast #xxx.lasersManager.laserFast.setEnabled(True)
 
@@ -137,7 +206,9 @@ class EtSTEDController():
         else:
             # disconnect signals and turn off wf laser
             # disconnect signal from update of image to running pipeline #xxx.sigUpdateImage.disconnect(self.runPipeline)
-            self.camImgWorker.newFrame.disconnect(self.runPipeline)  # mock: directly from mock camera worker
+            self.camImgWorker.newFrame.disconnect(self.analysisWorker.putFrame)  # mock: directly from mock camera worker
+            self.analysisWorker.clearFrame()
+            self.setBinaryMaskRefresh(False)
             # disconnect signal from end of scan to scanEnded() #xxx.sigScanEnded.disconnect(self.scanEnded)
             # turn off laserFast #xxx.lasersManager.laserFast.setEnabled(False)
 
@@ -145,13 +216,17 @@ class EtSTEDController():
             self._widget.initiateButton.setText('Initiate')
             self.resetParamVals()
             self.resetRunParams()
+            self.eventStore.flush()
+            self.stackWriter.endSession()
+            self.dumpLatencySummary()
 
     def scanEnded(self):
         """ End an etSTED slow method scan. """
-        self.setDetLogLine("scan_end",datetime.now().strftime('%Ss%fus'))
+        self.setDetLogLine("scan_end", time.perf_counter_ns())
         # emit signal to save the last scanned image #xxx.sigSnapImg.emit()
         self.endRecording()
-        self.continueFastModality()
+        # continue in the GUI thread, as the (mock) scan ends in the analysis thread
+        self.analysisWorker.continueRequested.emit()
         self.__fast_frame = 0
 
     def setDetLogLine(self, key, val, *args):
@@ -168,17 +243,19 @@ class EtSTEDController():
 
     def endRecording(self):
         """ Save an etSTED slow method scan. """
-        self.setDetLogLine("pipeline", self.getPipelineName())
-        self.logPipelineParamVals()
-        # save log file with temporal info of trigger event
-        filename = datetime.utcnow().strftime('%Hh%Mm%Ss%fus')
-        name = os.path.join(_logsDir, filename) + '_log'
-        savename = getUniqueName(name)
-        log = [f'{key}: {self.__detLog[key]}' for key in self.__detLog]
-        with open(f'{savename}.txt', 'w') as f:
-            [f.write(f'{st}\n') for st in log]
+        self.setDetLogLine("wall_time", time.time())
+        self.setDetLogLine("frames_dropped", self.camImgWorker.framesDropped)
+        self.setDetLogLine("frames_dropped_busy", self.analysisWorker.framesDroppedBusy)
+        # add event with temporal info of trigger event to the event store, saved in the background
+        self.eventStore.addEvent(self.__detLog)
         self.resetDetLog()
 
+    def dumpLatencySummary(self):
+        """ Save a summary of the latency statistics of the frame-to-scan stages of the session. """
+        if self.latencyStats.stages():
+            os.makedirs(_logsDir, exist_ok=True)
+            self.latencyStats.dumpSummary(self.logWriter.newName('latency') + '.txt')
+
     def getTransformName(self):
         """ Get the name of the pipeline currently used. """
         transformidx = self._widget.transformPipelinePar.currentIndex()
@@ -191,22 +268,18 @@ class EtSTEDController():
         pipelinename = self._widget.analysisPipelines[pipelineidx]
         return pipelinename
 
-    def logPipelineParamVals(self):
-        """ Put analysis pipeline parameter values in the log file. """
-        params_ignore = ['img','bkg','binary_mask','testmode','exinfo']
-        param_names = list()
-        for pipeline_param_name, _ in self.__pipeline_params.items():
-            if pipeline_param_name not in params_ignore:
-                param_names.append(pipeline_param_name)
-        for key, val in zip(param_names, self.__param_vals):
-            self.setDetLogLine(key, val)
+    def getPipelineParamNames(self):
+        """ Get the names of the user-provided analysis pipeline parameters. """
+        return [name for name in self.__pipeline_params if name not in self.__params_exclude]
 
     def continueFastModality(self):
-        """ Continue the fast method, after an event scan has been performed. """
+        """ Continue the fast method, after an event scan has been performed. Runs in the GUI thread. """
         if self._widget.endlessScanCheck.isChecked() and not self.__running:
             # connect communication channel signals
             # connect signal from update of image to running pipeline #xxx.sigUpdateImage.connect(self.runPipeline)
-            self.camImgWorker.newFrame.connect(self.runPipeline)  # mock: directly from mock camera worker
+            self.camImgWorker.newFrame.connect(self.analysisWorker.putFrame, Qt.DirectConnection)  # mock: directly from mock camera worker
+            self.analysisWorker.resume()
+            self.setBinaryMaskRefresh(self._widget.binaryRefreshCheck.isChecked())
             # turn on laserFast #xxx.lasersManager.laserFast.setEnabled(True)
             self._widget.eventScatterPlot.show()
             self._widget.initiateButton.setText('Stop')
@@ -216,6 +289,9 @@ class EtSTEDController():
             self._widget.initiateButton.setText('Initiate')
             self.__running = False
             self.resetParamVals()
+            self.eventStore.flush()
+            self.stackWriter.endSession()
+            self.dumpLatencySummary()
 
     def loadTransform(self):
         """ Load a previously saved coordinate transform. """
@@ -227,40 +303,120 @@ class EtSTEDController():
         pipelinename = self.getPipelineName()
         self.pipeline = getattr(importlib.import_module(f'{pipelinename}'), f'{pipelinename}')
         self.__pipeline_params = signature(self.pipeline).parameters
+        # pass messages logged by the pipeline (and the pipeline a CPU version runs) and the shared pipeline tools on
+        # to the log writer, rate limited
+        for name in (self.pipeline.__module__, basePipelineName(self.pipeline.__module__), 'pipeline_tools'):
+            pipelineLogger = logging.getLogger(name)
+            pipelineLogger.setLevel(logging.INFO)
+            if self.logWriter.handler not in pipelineLogger.handlers:
+                pipelineLogger.addHandler(self.logWriter.handler)
+        # keep the summed-area tables of the previous frames only for pipelines declaring that they sum windows in them
+        # (USES_INTEGRALS), as computing them for every frame costs more than the rest of the frame handling on large frames
+        self.__prevFrames.setIntegral(bool(getattr(sys.modules[self.pipeline.__module__], 'USES_INTEGRALS', False)))
         self._widget.initParamFields(self.__pipeline_params, self.__params_exclude)
 
+    def setPipelineProcess(self, enabled):
+        """ Start a worker process running the loaded pipeline, or reset the exinfo of the running one, if enabled,
+        otherwise stop any running one. In process mode the frame history is kept in shared memory. """
+        pipelinename = self.pipeline.__name__
+        if self.__pipelineProcess is not None and (not enabled or self.__pipelineProcess.pipelinename != pipelinename):
+            self.__prevFrames.setAllocator(None)
+            self.__pipelineProcess.close()
+            self.__pipelineProcess = None
+        if enabled:
+            if self.__pipelineProcess is None:
+                self.__pipelineProcess = PipelineProcess(pipelinename, self.analysisDir)
+                self.__prevFrames.setAllocator(self.__pipelineProcess.empty)
+            else:
+                self.__pipelineProcess.reset()
+
     def initiateBinaryMask(self):
         """ Initiate the process of calculating a binary mask of the region of interest. """
-        self.__binary_stack = None
+        self.setBinaryMaskRefresh(False)
+        self.resetBinarySum()
         # turn on laserFast #xxx.lasersManager.laserFast.setEnabled(True)
-        # connect signal from update of image to saving the image in the stack of images for binary mask calculation
+        # connect signal from update of image to adding the image to the running sum of images for binary mask calculation
         self.camImgWorker.newFrame.connect(self.addImgBinStack)
         self._widget.recordBinaryMaskButton.setText('Recording...')
 
-    def addImgBinStack(self, img):
-        """ Add image to the stack of images used to calculate a binary mask of the region of interest. """
-        if self.__binary_stack is None:
-            self.__binary_stack = img
-        elif len(self.__binary_stack) == self.__binary_frames:
-            # disconnect signal from update of image to saving the image in the stack of images for binary mask calculation
-            self.camImgWorker.newFrame.disconnect(self.addImgBinStack)
-            # turn off laserFast #xxx.lasersManager.laserFast.setEnabled(False)
-            self.calculateBinaryMask(self.__binary_stack)
+    def setBinaryMaskRefresh(self, enabled):
+        """ Start or stop recalculating the binary mask in the background from the latest frames, during an experiment. """
+        if enabled == self.__binary_refreshing:
+            return
+        if enabled:
+            self.resetBinarySum()
+            self.camImgWorker.newFrame.connect(self.addImgBinStack)
         else:
-            if np.ndim(self.__binary_stack) == 2:
-                self.__binary_stack = np.stack((self.__binary_stack, img))
+            try:
+                self.camImgWorker.newFrame.disconnect(self.addImgBinStack)
+            except TypeError:
+                pass
+        self.__binary_refreshing = enabled
+
+    def resetBinarySum(self):
+        """ Reset the running sum of images used to calculate a binary mask, keeping the allocated sum. """
+        if self.__binary_sum is not None:
+            self.__binary_sum.fill(0)
+        self.__binary_count = 0
+
+    def addImgBinStack(self, img, *args):
+        """ Add image to the running sum of images used to calculate a binary mask of the region of interest. """
+        if self.__binary_sum is None or self.__binary_sum.shape != np.shape(img):
+            self.__binary_sum = np.zeros(np.shape(img), dtype=np.float64)
+            self.__binary_count = 0
+        np.add(self.__binary_sum, img, out=self.__binary_sum)
+        self.__binary_count += 1
+        if self.__binary_count == self.__binary_frames:
+            img_mean = self.__binary_sum / self.__binary_count
+            self.resetBinarySum()
+            smooth = float(self._widget.bin_smooth_edit.text())
+            thresh = float(self._widget.bin_thresh_edit.text())
+            if self.__binary_refreshing:
+                # recalculate in the background, and keep recording the next frames
+                self.__binaryMaskExecutor.submit(self.refreshBinaryMask, img_mean, smooth, thresh)
             else:
-                self.__binary_stack = np.concatenate((self.__binary_stack,  [img]), axis=0)
+                # disconnect signal from update of image to adding the image to the running sum of images for binary mask calculation
+                self.camImgWorker.newFrame.disconnect(self.addImgBinStack)
+                # turn off laserFast #xxx.lasersManager.laserFast.setEnabled(False)
+                self.calculateBinaryMask(img_mean, smooth, thresh)
 
-    def calculateBinaryMask(self, img_stack):
+    def calculateBinaryMask(self, img_mean, smooth, thresh):
         """ Calculate the binary mask of the region of interest. """
-        img_mean = np.mean(img_stack, 0)
-        img_bin = ndi.filters.gaussian_filter(img_mean, np.float(self._widget.bin_smooth_edit.text()))
-        self.__binary_mask = np.array(img_bin > np.float(self._widget.bin_thresh_edit.text()))
+        self.__binary_mask = self.getBinaryMask(img_mean, smooth, thresh)
         self._widget.recordBinaryMaskButton.setText('Record binary mask')
         self.setAnalysisHelpImg(self.__binary_mask)
         self.launchHelpWidget()
 
+    def getBinaryMask(self, img_mean, smooth, thresh):
+        """ Get a binary mask of the region of interest, from the smoothed and thresholded mean image. """
+        img_bin = ndi.filters.gaussian_filter(img_mean, smooth)
+        return np.array(img_bin > thresh)
+
+    def refreshBinaryMask(self, img_mean, smooth, thresh):
+        """ Recalculate the binary mask of the region of interest in the background, replacing the mask used by the pipeline at once. """
+        try:
+            self.__binary_mask = self.getBinaryMask(img_mean, smooth, thresh)
+        except Exception:
+            traceback.print_exc()
+
+    def getMaskCrop(self, img):
+        """ Get the crop of the frames to the bounding box of the binary mask, recalculated when the mask changes,
+        or None to run the pipeline on the whole frames. As the pipeline state in exinfo is in the coordinates
+        of the crop, it is reset if the crop changes during an experiment. """
+        mask = self.__binary_mask
+        if not self.__crop_to_mask or mask is None or np.shape(mask) != np.shape(img):
+            crop = None
+        elif self.__mask_crop is not None and self.__mask_crop.source is mask:
+            return self.__mask_crop
+        else:
+            crop = MaskCrop(mask, self.__crop_margin)
+        if crop != self.__mask_crop:
+            self.__exinfo = None
+            if self.__pipelineProcess is not None:
+                self.__pipelineProcess.reset()
+        self.__mask_crop = crop
+        return crop
+
     def setAnalysisHelpImg(self, img):
         """ Set the preprocessed image in the analysis help widget. """
         if self.__fast_frame < self.__init_frames + 3:
@@ -281,9 +437,28 @@ class EtSTEDController():
             'dwell_time': 0.03
         }
 
-    def setBusyFalse(self):
-        """ Set busy flag to false. """
-        self.__busy = False
+    def unlockSoftlock(self):
+        """ Drop any frame waiting for analysis and stop any ongoing binary mask recording. """
+        self.analysisWorker.clearFrame()
+        self.__binary_refreshing = False
+        try:
+            self.camImgWorker.newFrame.disconnect(self.addImgBinStack)
+            self._widget.recordBinaryMaskButton.setText('Record binary mask')
+        except TypeError:
+            pass
+
+    def getFrameCounters(self):
+        """ Get the number of received, dropped (by the camera), analysed, and dropped (analysis busy) frames,
+        and the counters of the camera if it keeps any (e.g. delivered frames of the replay camera). """
+        counters = {
+            'frames_received': self.camImgWorker.framesReceived,
+            'frames_dropped': self.camImgWorker.framesDropped,
+            'frames_analysed': self.analysisWorker.framesAnalysed,
+            'frames_dropped_busy': self.analysisWorker.framesDroppedBusy
+        }
+        if hasattr(self.camera, 'getFrameCounters'):
+            counters.update({f'camera_{key}': val for key, val in self.camera.getFrameCounters().items()})
+        return counters
 
     def updateScatter(self, coords):
         """ Update the scatter plot of detected event coordinates. """
@@ -319,117 +494,144 @@ class EtSTEDController():
         self.__fast_frame = 0
         self.__post_event_frames = 0
 
-    def runPipeline(self, img):
-        """ Run the analyis pipeline, called after every fast method frame. """
-        if not self.__busy:
-            # if not still running pipeline on last frame
-            self.__busy = True
+    def runPipeline(self, img, frameNumber=None, timestamp=None):
+        """ Run the analyis pipeline, called from the analysis thread for the latest fast method frame. """
+        # all timestamps are monotonic-clock timestamps in ns (time.perf_counter_ns)
+        t_pipeline_start = time.perf_counter_ns()
+        self.setDetLogLine("frame_number", frameNumber)
+        if timestamp is not None:
+            # log frame capture timestamp and time from capture to pipeline start
+            self.setDetLogLine("frame_timestamp", timestamp)
+            self.latencyStats.record('frame_to_pipeline', t_pipeline_start - timestamp)
+        if self.__t_lastcall is not None:
             # get time since last pipeline run (ms) and log
-            dt = datetime.now()
-            self.t_latestcall = round(dt.microsecond/1000)
-            t_sincelastcall = self.t_latestcall - self.t_call
-            self.t_call = self.t_latestcall
-            self.setDetLogLine("pipeline_rep_period", str(t_sincelastcall))
-            self.setDetLogLine("pipeline_start", datetime.now().strftime('%Ss%fus'))
-
-            # run pipeline
+            self.setDetLogLine("pipeline_rep_period", (t_pipeline_start - self.__t_lastcall)/1e6)
+            self.latencyStats.record('pipeline_rep_period', t_pipeline_start - self.__t_lastcall)
+        self.__t_lastcall = t_pipeline_start
+        self.setDetLogLine("pipeline_start", t_pipeline_start)
+
+        # crop the current and previous frames and the binary mask to the bounding box of the mask, if set
+        mask_crop = self.getMaskCrop(img)
+        if mask_crop is not None:
+            img_run, prev_frames, binary_mask = mask_crop.crop(img), mask_crop.crop(self.__prevFrames.last()), mask_crop.mask
+        else:
+            img_run, prev_frames, binary_mask = img, self.__prevFrames.last(), self.__binary_mask
+
+        # run pipeline
+        if self.__pipelineProcess is not None:
+            # if running pipeline in a separate process: exinfo is kept in the worker process
             if self.__runMode == RunMode.TestVisualize or self.__runMode == RunMode.TestValidate:
-                # if chosen a test mode: run pipeline with analysis image return
-                coords_detected, self.__exinfo, img_ana = self.pipeline(img, self.__prevFrames, self.__binary_mask,
-                                                                        (self.__runMode==RunMode.TestVisualize or
-                                                                        self.__runMode==RunMode.TestValidate),
-                                                                        self.__exinfo, *self.__param_vals)
+                coords_detected, img_ana = self.__pipelineProcess.run(img_run, prev_frames, binary_mask,
+                                                                      True, self.__param_vals)
             else:
-                # if chosen experiment mode: run pipeline without analysis image return
-                coords_detected, self.__exinfo = self.pipeline(img, self.__prevFrames, self.__binary_mask,
-                                                               self.__runMode==RunMode.TestVisualize,
-                                                               self.__exinfo, *self.__param_vals)
-            self.setDetLogLine("pipeline_end", datetime.now().strftime('%Ss%fus'))
-
-            if self.__fast_frame > self.__init_frames:
-                # if initial settling frames have passed
-                if self.__runMode == RunMode.TestVisualize:
-                    # if visualization mode: only update scatter and set analysis image in help widget
-                    self.updateScatter(coords_detected)
-                    self.setAnalysisHelpImg(img_ana)
-                elif self.__runMode == RunMode.TestValidate:
-                    # if validation mode: update scatter, set analysis image in help widget,
-                    # and start to record validation frames after event
-                    self.updateScatter(coords_detected)
-                    self.setAnalysisHelpImg(img_ana)
-                    if self.__validating:
-                        # if currently validating
-                        if self.__post_event_frames > self.__validation_frames:
-                            # if all validation frames have been recorded, pause fast imaging,
-                            # end recording, and then continue fast imaging
-                            self.saveValidationImages(prev=True, prev_ana=True)
-                            self.pauseFastModality()
-                            self.endRecording()
-                            self.continueFastModality()
-                            self.__fast_frame = 0
-                            self.__validating = False
-                        self.__post_event_frames += 1
-                    elif coords_detected.size != 0:
-                        # if some events where detected and not validating
-                        # take first detected coords as event
-                        if np.size(coords_detected) > 2:
-                            coords_scan = coords_detected[0,:]
-                        else:
-                            coords_scan = coords_detected[0]
-                        # log detected center coordinate
-                        self.setDetLogLine("fastscan_x_center", coords_scan[0])
-                        self.setDetLogLine("fastscan_y_center", coords_scan[1])
-                        # log all detected coordinates
-                        if np.size(coords_detected) > 2:
-                            for i in range(np.size(coords_detected,0)):
-                                self.setDetLogLine("det_coord_x_", coords_detected[i,0], i)
-                                self.setDetLogLine("det_coord_y_", coords_detected[i,1], i)
-                        # flag for start of validation
-                        self.__validating = True
-                        self.__post_event_frames = 0
+                coords_detected = self.__pipelineProcess.run(img_run, prev_frames, binary_mask,
+                                                             False, self.__param_vals)
+        elif self.__runMode == RunMode.TestVisualize or self.__runMode == RunMode.TestValidate:
+            # if chosen a test mode: run pipeline with analysis image return
+            coords_detected, self.__exinfo, img_ana = self.pipeline(img_run, prev_frames, binary_mask,
+                                                                    (self.__runMode==RunMode.TestVisualize or
+                                                                    self.__runMode==RunMode.TestValidate),
+                                                                    self.__exinfo, *self.__param_vals)
+        else:
+            # if chosen experiment mode: run pipeline without analysis image return
+            coords_detected, self.__exinfo = self.pipeline(img_run, prev_frames, binary_mask,
+                                                           self.__runMode==RunMode.TestVisualize,
+                                                           self.__exinfo, *self.__param_vals)
+        if mask_crop is not None:
+            # translate the coordinates (and the analysis image) from the crop back to the whole frame
+            coords_detected = mask_crop.translate(coords_detected)
+            if self.__runMode == RunMode.TestVisualize or self.__runMode == RunMode.TestValidate:
+                img_ana = mask_crop.uncrop(img_ana)
+        t_pipeline_end = time.perf_counter_ns()
+        self.setDetLogLine("pipeline_end", t_pipeline_end)
+        self.latencyStats.record('pipeline', t_pipeline_end - t_pipeline_start)
+
+        if self.__fast_frame > self.__init_frames:
+            # if initial settling frames have passed
+            if self.__runMode == RunMode.TestVisualize:
+                # if visualization mode: only update scatter and set analysis image in help widget
+                self.analysisWorker.coordsDetected.emit(coords_detected)
+                self.analysisWorker.analysisImage.emit(img_ana)
+            elif self.__runMode == RunMode.TestValidate:
+                # if validation mode: update scatter, set analysis image in help widget,
+                # and start to record validation frames after event
+                self.analysisWorker.coordsDetected.emit(coords_detected)
+                self.analysisWorker.analysisImage.emit(img_ana)
+                if self.__validating:
+                    # if currently validating
+                    if self.__post_event_frames > self.__validation_frames:
+                        # if all validation frames have been recorded, pause fast imaging,
+                        # end recording, and then continue fast imaging
+                        self.saveValidationImages(prev=True, prev_ana=True)
+                        self.requestPauseFastModality()
+                        self.endRecording()
+                        self.analysisWorker.continueRequested.emit()
+                        self.__fast_frame = 0
+                        self.__validating = False
+                    self.__post_event_frames += 1
                 elif coords_detected.size != 0:
-                    # if experiment mode, and some events were detected
+                    # if some events where detected and not validating
                     # take first detected coords as event
                     if np.size(coords_detected) > 2:
                         coords_scan = coords_detected[0,:]
                     else:
                         coords_scan = coords_detected[0]
-                    self.setDetLogLine("prepause", datetime.now().strftime('%Ss%fus'))
-                    # pause fast imaging
-                    self.pauseFastModality()
-                    self.setDetLogLine("coord_transf_start", datetime.now().strftime('%Ss%fus'))
-                    # transform detected coordinate between fast and scanning imaging spaces
-                    coords_center_scan = self.transform(coords_scan, self.__transformCoeffs)
-                    # log detected and scanning center coordinate
+                    # log detected center coordinate
                     self.setDetLogLine("fastscan_x_center", coords_scan[0])
                     self.setDetLogLine("fastscan_y_center", coords_scan[1])
-                    self.setDetLogLine("slowscan_x_center", coords_center_scan[0])
-                    self.setDetLogLine("slowscan_y_center", coords_center_scan[1])
-                    self.setDetLogLine("scan_initiate", datetime.now().strftime('%Ss%fus'))
                     # log all detected coordinates
-                    if np.size(coords_detected) > 2:
-                        for i in range(np.size(coords_detected,0)):
-                            self.setDetLogLine("det_coord_x_", coords_scan[0], i)
-                            self.setDetLogLine("det_coord_y_", coords_scan[1], i)
-                    # initiate and run scanning with transformed center coordinate
-                    self.initiateSlowScan(position=coords_center_scan)
-                    self.runSlowScan()
-
-                    # update scatter plot of event coordinates in the shown fast method image
-                    self.updateScatter(coords_detected)
-                    # buffer latest fast frame and save validation images
-                    self.__prevFrames.append(img)
-                    self.saveValidationImages(prev=True, prev_ana=False)
-                    self.setBusyFalse()
-                    return
-            # buffer latest fast frame and save validation images
-            self.__prevFrames.append(img)
-            if self.__runMode == RunMode.TestValidate:
-                # if validation mode: buffer previous preprocessed analysis frame
-                self.__prevAnaFrames.append(img_ana)
-            self.__fast_frame += 1
-            # unset busy flag
-            self.setBusyFalse()
+                    self.setDetLogLine("det_coords", coords_detected)
+                    # flag for start of validation
+                    self.__validating = True
+                    self.__post_event_frames = 0
+            elif coords_detected.size != 0:
+                # if experiment mode, and some events were detected
+                # take first detected coords as event
+                if np.size(coords_detected) > 2:
+                    coords_scan = coords_detected[0,:]
+                else:
+                    coords_scan = coords_detected[0]
+                self.setDetLogLine("prepause", time.perf_counter_ns())
+                # pause fast imaging
+                self.requestPauseFastModality()
+                t_transform_start = time.perf_counter_ns()
+                self.setDetLogLine("coord_transf_start", t_transform_start)
+                # transform detected coordinate between fast and scanning imaging spaces
+                coords_center_scan = self.transform(coords_scan, self.__transformCoeffs)
+                t_transform_end = time.perf_counter_ns()
+                self.setDetLogLine("coord_transf_end", t_transform_end)
+                self.latencyStats.record('transform', t_transform_end - t_transform_start)
+                # log detected and scanning center coordinate
+                self.setDetLogLine("fastscan_x_center", coords_scan[0])
+                self.setDetLogLine("fastscan_y_center", coords_scan[1])
+                self.setDetLogLine("slowscan_x_center", coords_center_scan[0])
+                self.setDetLogLine("slowscan_y_center", coords_center_scan[1])
+                t_scan_initiate = time.perf_counter_ns()
+                self.setDetLogLine("scan_initiate", t_scan_initiate)
+                self.latencyStats.record('trigger_to_scan', t_scan_initiate - t_pipeline_end)
+                if timestamp is not None:
+                    self.latencyStats.record('frame_to_scan', t_scan_initiate - timestamp)
+                # log all detected coordinates
+                self.setDetLogLine("det_coords", coords_detected)
+                # initiate and run scanning with transformed center coordinate
+                self.initiateSlowScan(position=coords_center_scan)
+                self.runSlowScan()
+
+                # update scatter plot of event coordinates in the shown fast method image
+                self.analysisWorker.coordsDetected.emit(coords_detected)
+                # buffer latest fast frame and save validation images
+                self.__prevFrames.append(img)
+                self.stackWriter.addFrame('raw', img, frameNumber)
+                self.saveValidationImages(prev=True, prev_ana=False)
+                return
+        # buffer latest fast frame and save validation images
+        self.__prevFrames.append(img)
+        self.stackWriter.addFrame('raw', img, frameNumber)
+        if self.__runMode == RunMode.TestValidate:
+            # if validation mode: buffer previous preprocessed analysis frame
+            self.__prevAnaFrames.append(img_ana)
+            self.stackWriter.addFrame('ana', img_ana, frameNumber)
+        self.__fast_frame += 1
 
     def initiateSlowScan(self, position=[0.0,0.0]):
         """ Initiate a STED scan. """
@@ -467,26 +669,52 @@ class EtSTEDController():
         return(center)
 
     def saveValidationImages(self, prev=True, prev_ana=True):
-        """ Save the validation fast images of an event detection, fast images and/or preprocessed analysis images. """
+        """ Save the validation fast images of an event detection, fast images and/or preprocessed analysis images.
+        The frames are saved in the background by the stack writer, which has been passed the same frames as the buffers. """
+        kinds = list()
         if prev:
-            # save detectorFast frames leading up to event #xxx.sigSaveImage.emit(self.detectorFast, np.array(list(self.__prevFrames)), 'raw') # (detector, imagestack, name_suffix)
+            # save detectorFast frames leading up to event
+            kinds.append('raw')
             self.__prevFrames.clear()
         if prev_ana:
-            # save preprocessed images leading up to event #xxx.sigSaveImage.emit(self.detectorFast, np.array(list(self.__prevAnaFrames)), 'ana') # (detector, imagestack, name_suffix)
+            # save preprocessed images leading up to event
+            kinds.append('ana')
             self.__prevAnaFrames.clear()
+        self.stackWriter.saveEvent(kinds)
+
+    def requestPauseFastModality(self):
+        """ Pause the fast method from the analysis thread, when an event has been detected: stop analysing new
+        frames at once, and disconnect the frames in the GUI thread. """
+        self.analysisWorker.pause()
+        # do not count the pause in the pipeline repetition period
+        self.__t_lastcall = None
+        self.analysisWorker.pauseRequested.emit()
 
     def pauseFastModality(self):
-        """ Pause the fast method, when an event has been detected. """
+        """ Pause the fast method, when an event has been detected. Runs in the GUI thread. """
         if self.__running:
             # disconnect signal from update of image to running pipeline #xxx.sigUpdateImage.disconnect(self.runPipeline)
-            self.camImgWorker.newFrame.disconnect(self.runPipeline)  # mock: directly from mock camera worker
+            self.camImgWorker.newFrame.disconnect(self.analysisWorker.putFrame)  # mock: directly from mock camera worker
+            self.analysisWorker.clearFrame()
+            # do not record the frames without the fast laser for the binary mask
+            self.setBinaryMaskRefresh(False)
             # turn off fast laser xxx.lasersManager.laserFast.setEnabled(False)
             self.__running = False
 
     def closeEvent(self, *args):
-        print('what')
-        #self.camImgWorker.
+        self.eventStore.flush()
+        self.logWriter.flush()
+        self.stackWriter.endSession()
+        self.stackWriter.flush()
+        if self.__pipelineProcess is not None:
+            self.__pipelineProcess.close()
+        self.__binaryMaskExecutor.shutdown(wait=False)
+        self.analysisWorker.stop()
+        self.analysisThread.quit()
         self.camImgThread.quit()
+        # stop a camera streaming from a file (replay camera), closing the file
+        if hasattr(self.camera, 'close'):
+            self.camera.close()
 
 
 class EtSTEDCoordTransformHelper():
@@ -629,27 +857,118 @@ class EtSTEDCoordTransformHelper():
 
 
 class CameraImageWorker(QObject):
-    """ Worker for handling pulling of camera images. """
+    """ Worker for handling new frames pushed from the camera. """
     started = pyqtSignal()
     finished = pyqtSignal()
-    newFrame = pyqtSignal(object)
+    newFrame = pyqtSignal(object, int, object)  # (img, frame number, capture timestamp (ns))
 
     def __init__(self, controller, camera):
         QThread.__init__(self)
-        self.timer = QTimer(self)
         self.controller = controller
         self.camera = camera
+        self.resetFrameCounters()
+
+    def resetFrameCounters(self):
+        """ Reset the counters of received and dropped frames. """
+        self.lastFrameNumber = None
+        self.lastTimestamp = None
+        self.framesReceived = 0
+        self.framesDropped = 0
+
+    def updateImg(self, img, frameNumber, timestamp):
+        """ Update the shown image with a new frame from the camera, count any frames dropped
+        since the last one from gaps in the frame numbers, and pass the frame on. """
+        if self.lastFrameNumber is not None and frameNumber > self.lastFrameNumber + 1:
+            self.framesDropped += frameNumber - self.lastFrameNumber - 1
+        if self.lastTimestamp is not None and timestamp is not None:
+            self.controller.latencyStats.record('frame_period', timestamp - self.lastTimestamp)
+        self.lastFrameNumber = frameNumber
+        self.lastTimestamp = timestamp
+        self.framesReceived += 1
+        self.controller.camImageLayer.data = img
+        self.newFrame.emit(img, frameNumber, timestamp)
+
+    def run(self):
+        # mock: connect directly to the new frame signal of the mock camera
+        # real use-case: connect to the image updated signal of the software where implemented
+        self.camera.sigNewFrame.connect(self.updateImg)
 
-    def updateImg(self):
-        """ Check if the latest grabbed frame from the camera is new. """
-        newimg = self.camera.getImage()
-        if not np.array_equal(newimg, self.controller.camImageLayer.data):
-            self.controller.camImageLayer.data = newimg
-            self.newFrame.emit(newimg)
+
+class AnalysisWorker(QObject):
+    """ Worker running the analysis pipeline in its own thread. New frames are put in a
+    single-slot queue, where a frame not yet picked up for analysis is replaced by the newer
+    one, so that the analysis always runs on the latest frame and never blocks acquisition. """
+    started = pyqtSignal()
+    finished = pyqtSignal()
+    frameAnalysed = pyqtSignal(object)  # frame number of the frame analysed
+    coordsDetected = pyqtSignal(object)  # coordinates detected in the frame, to show in the GUI thread
+    analysisImage = pyqtSignal(object)  # analysis image of the frame, to show in the GUI thread
+    pauseRequested = pyqtSignal()  # pause of the fast method after an event, to run in the GUI thread
+    continueRequested = pyqtSignal()  # continuation of the fast method after an event, to run in the GUI thread
+
+    def __init__(self, controller):
+        QObject.__init__(self)
+        self.controller = controller
+        self.__condition = threading.Condition()
+        self.__frame = None  # single-slot queue: (img, frame number, timestamp) or None
+        self.__running = False
+        self.__paused = False  # drop new frames, while the fast method is paused after an event
+        self.resetFrameCounters()
+
+    def resetFrameCounters(self):
+        """ Reset the counters of analysed frames and frames dropped due to a busy analysis. """
+        self.framesAnalysed = 0
+        self.framesDroppedBusy = 0
+
+    def putFrame(self, img, frameNumber=None, timestamp=None):
+        """ Put a new frame in the queue, replacing any frame still waiting for analysis. """
+        with self.__condition:
+            if self.__paused:
+                return
+            if self.__frame is not None:
+                self.framesDroppedBusy += 1
+            self.__frame = (img, frameNumber, timestamp)
+            self.__condition.notify()
+
+    def clearFrame(self):
+        """ Drop any frame waiting for analysis. """
+        with self.__condition:
+            self.__frame = None
+
+    def pause(self):
+        """ Drop any frame waiting for analysis, and all new frames until resumed. """
+        with self.__condition:
+            self.__paused = True
+            self.__frame = None
+
+    def resume(self):
+        """ Accept new frames for analysis again. """
+        with self.__condition:
+            self.__paused = False
 
     def run(self):
-        self.timer.timeout.connect(self.updateImg)
-        self.timer.start(self.camera.properties['update_time']/2)
+        self.__running = True
+        while True:
+            with self.__condition:
+                while self.__frame is None and self.__running:
+                    self.__condition.wait()
+                if not self.__running:
+                    break
+                img, frameNumber, timestamp = self.__frame
+                self.__frame = None
+            try:
+                self.controller.runPipeline(img, frameNumber, timestamp)
+            except Exception:
+                traceback.print_exc()
+            self.framesAnalysed += 1
+            self.frameAnalysed.emit(frameNumber)
+        self.finished.emit()
+
+    def stop(self):
+        """ Stop the analysis loop. """
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
 
 
 class RunMode(enum.Enum):
@@ -657,24 +976,6 @@ class RunMode(enum.Enum):
     TestVisualize = 2
     TestValidate = 3
 
-def insertSuffix(filename, suffix, newExt=None):
-    names = os.path.splitext(filename)
-    if newExt is None:
-        return names[0] + suffix + names[1]
-    else:
-        return names[0] + suffix + newExt
-
-def getUniqueName(name):
-    name, ext = os.path.splitext(name)
-    n = 1
-    while glob.glob(name + ".*"):
-        if n > 1:
-            name = name.replace('_{}'.format(n - 1), '_{}'.format(n))
-        else:
-            name = insertSuffix(name, '_{}'.format(n))
-        n += 1
-    return ''.join((name, ext))
-
 
 # Copyright (C) 2020-2022 ImSwitch developers
 #
@@ -56,6 +56,15 @@ class EtSTEDWidget(QtWidgets.QWidget):
         self.setBusyFalseButton = QtWidgets.QPushButton('Unlock softlock')
         # create check box for endless running mode
         self.endlessScanCheck = QtWidgets.QCheckBox('Endless')
+        # create check box for running the analysis pipeline in a separate process
+        self.processModeCheck = QtWidgets.QCheckBox('Separate process')
+        # create check box for refreshing the binary mask in the background during experiments
+        self.binaryRefreshCheck = QtWidgets.QCheckBox('Refresh bin. mask')
+        # create check box for running the analysis pipeline on only the bounding box of the binary mask
+        self.cropMaskCheck = QtWidgets.QCheckBox('Crop to bin. mask')
+        self.cropMaskCheck.setChecked(True)
+        # create check box for streaming every fast frame to disk, and not only the frames of detected events
+        self.streamFramesCheck = QtWidgets.QCheckBox('Stream all frames')
         # create editable fields for binary mask calculation threshold and smoothing
         self.bin_thresh_label = QtWidgets.QLabel('Bin. threshold')
         self.bin_thresh_label.setAlignment(QtCore.Qt.AlignLeft | QtCore.Qt.AlignBottom)
@@ -105,6 +114,8 @@ class EtSTEDWidget(QtWidgets.QWidget):
 
         currentRow += 1
 
+        self.grid.addWidget(self.streamFramesCheck, currentRow, 2)
+        self.grid.addWidget(self.processModeCheck, currentRow, 3)
         self.grid.addWidget(self.recordBinaryMaskButton, currentRow, 4)
 
         currentRow +=1
@@ -122,6 +133,11 @@ class EtSTEDWidget(QtWidgets.QWidget):
         self.grid.addWidget(self.loadScanParametersButton, currentRow, 3)
         self.grid.addWidget(self.setBusyFalseButton, currentRow, 4)
 
+        currentRow +=1
+
+        self.grid.addWidget(self.binaryRefreshCheck, currentRow, 3)
+        self.grid.addWidget(self.cropMaskCheck, currentRow, 4)
+
     def initParamFields(self, parameters: dict, params_exclude: list):
         """ Initialized event-triggered analysis pipeline parameter fields. """
         # remove previous parameter fields for the previously loaded pipeline
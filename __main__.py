@@ -1,6 +1,7 @@
 from EtSTEDController import EtSTEDController
 from EtSTEDWidget import EtSTEDWidget
 from mockcamera import MockCamera
+from replaycamera import ReplayCamera
 from PyQt5 import QtWidgets
 import sys
 
@@ -9,9 +10,12 @@ _setupInfo = None
 
 if __name__ == "__main__":
     etSTEDapp = QtWidgets.QApplication(sys.argv)
-    camera = MockCamera()
+    # replay a recorded stack of frames if a HDF5 or TIFF file is given, otherwise simulate frames
+    camera = ReplayCamera(sys.argv[1]) if len(sys.argv) > 1 else MockCamera()
     widget = EtSTEDWidget()
     controller = EtSTEDController(camera, _setupInfo, widget)
+    # flush the writers and stop the workers, pipeline process and camera on exit
+    etSTEDapp.aboutToQuit.connect(controller.closeEvent)
     widget.show()
 
     sys.exit(etSTEDapp.exec_())
@@ -0,0 +1,14 @@
+""" Shared building blocks of the analysis pipelines. Kept in a package, so that they are not listed as pipelines. """
+from . import backend
+from .backend import get_backend, array_module, to_host
+from . import kernels
+from .kernels import ratio_change, clip_scale
+from .peaks import peak_local_max, select_peaks, ensure_spacing, in_bounds, top_k
+from .linking import StreamingLinker
+from .trackstore import TrackStore, summarize_tracks
+from .dog import DoGStage, dog_stage
+from .integral import integral_image, box_sums
+from .events import fusion_events, appearance_events
+from .coarse import bin_image, unbin_image, refine_peaks
+from .background import BackgroundCache, RunningBaseline, frame_ids
+from .spikes import analysis_image, baseline_image, spike_pipeline
@@ -0,0 +1,56 @@
+import contextlib
+import contextvars
+import functools
+import logging
+
+import numpy as np
+from scipy import ndimage as scipy_ndi
+
+logger = logging.getLogger(__name__)
+
+_backend = contextvars.ContextVar('backend', default='auto')  # backend of the pipelines run in the current context
+
+
+@functools.lru_cache(maxsize=1)
+def cupy_modules():
+    """ Get the cupy array and ndimage modules, imported once, or None if cupy or a CUDA device is not available. """
+    try:
+        import cupy as cp
+        from cupyx.scipy import ndimage as cupy_ndi
+        cp.cuda.runtime.getDeviceCount()  # raises without a CUDA driver or device
+    except Exception as e:
+        logger.warning(f'cupy not available, running the pipelines on the CPU: {e}')
+        return None
+    return cp, cupy_ndi
+
+
+@contextlib.contextmanager
+def use(name):
+    """ Run the pipelines called in the block on the 'numpy' or 'cupy' backend, or on cupy if available ('auto'). """
+    token = _backend.set(name)
+    try:
+        yield
+    finally:
+        _backend.reset(token)
+
+
+def get_backend():
+    """ Get the array module (numpy or cupy) and ndimage module (scipy or cupyx) of the current backend,
+    falling back to numpy and scipy if cupy is not available. """
+    if _backend.get() != 'numpy':
+        modules = cupy_modules()
+        if modules is not None:
+            return modules
+    return np, scipy_ndi
+
+
+def array_module(arr):
+    """ Get the array module (numpy or cupy) of an array. """
+    if hasattr(arr, 'get') and cupy_modules() is not None:
+        return cupy_modules()[0]
+    return np
+
+
+def to_host(arr):
+    """ Get an array as a numpy array, moving it from the GPU if needed. """
+    return arr.get() if hasattr(arr, 'get') else arr
@@ -0,0 +1,102 @@
+import numpy as np
+
+from .backend import array_module
+from .kernels import ratio_change
+
+
+def frame_ids(prev_frames):
+    """ Get the sequence numbers of the newest previous frame and of the current frame of a pipeline call, from the
+    frame history passed to the pipeline (prev_frames.ids and prev_frames.next_id, kept by the frame history of the
+    widget, where every analysed frame is appended after the call). None for the ones not known. """
+    ids, next_id = getattr(prev_frames, 'ids', None), getattr(prev_frames, 'next_id', None)
+    prev_id = int(ids[-1]) if ids is not None and len(ids) > 0 else None
+    return prev_id, None if next_id is None else int(next_id)
+
+
+class BackgroundCache:
+    """
+    Images derived from the current frame of a pipeline call (e.g. the smoothed frame), kept in exinfo to be
+    reused as the background of the next call, where the frame is the previous frame, so that every frame is
+    filtered once. Frames are identified by their sequence numbers in the frame history (frame_ids), never by
+    their pixels, so that the image of another frame is never returned, and nothing is kept for frames without
+    a sequence number. The images are kept under keys of the parameters they were derived with.
+    """
+
+    def __init__(self):
+        self.__frame_id = None  # sequence number of the kept frame
+        self.__images = dict()  # key: image derived from the kept frame
+
+    def get(self, frame_id, key):
+        """ Get the image derived from the frame with sequence number frame_id with key, if kept, otherwise None. """
+        if frame_id is None or frame_id != self.__frame_id:
+            return None
+        return self.__images.get(key)
+
+    def keep(self, frame_id, key, image):
+        """ Keep an image derived from the frame with sequence number frame_id with key, dropping the images of any
+        other kept frame. Nothing is kept if frame_id is None. """
+        if frame_id is None:
+            return
+        if frame_id != self.__frame_id:
+            self.__frame_id = frame_id
+            self.__images = dict()
+        self.__images[key] = image
+
+    def clear(self):
+        """ Drop the kept frame and images. """
+        self.__frame_id = None
+        self.__images = dict()
+
+
+class RunningBaseline:
+    """
+    Per-pixel running baseline of the frames, for a background with less noise than a single previous frame:
+    an exponential moving average of the frames (mean) with a weight alpha of the newest frame, and the matching
+    exponentially weighted variance (var), updated in place with Welford's recurrence. During the first 1/alpha
+    frames the weight is 1/count instead, giving the plain mean and variance of all frames so far. The memory and
+    the cost of an update are constant per frame. Frames are float32 numpy or cupy arrays.
+    """
+
+    def __init__(self, alpha=0.05, min_std=1.0):
+        self.alpha = alpha
+        self.min_std = min_std  # lower limit of the standard deviation in the z-scores, to not divide by 0
+        self.mean = None
+        self.var = None
+        self.count = 0  # number of frames in the baseline
+        self.__scratch = None  # scratch buffers of the updates
+
+    def reset(self):
+        """ Drop all frames from the baseline, keeping the allocated arrays. """
+        self.count = 0
+
+    def update(self, frame):
+        """ Add a frame to the baseline, in place. The baseline is reset if the frame shape or array type changes. """
+        xp = array_module(frame)
+        if self.mean is None or self.mean.shape != frame.shape or array_module(self.mean) is not xp:
+            self.mean, self.var, *self.__scratch = (xp.zeros(frame.shape, dtype=np.float32) for _ in range(4))
+            self.count = 0
+        self.count += 1
+        alpha = max(self.alpha, 1 / self.count)
+        diff, incr = self.__scratch
+        xp.subtract(frame, self.mean, out=diff)
+        xp.multiply(diff, np.float32(alpha), out=incr)
+        self.mean += incr
+        # var = (1 - alpha)*(var + diff*alpha*diff)
+        diff *= incr
+        self.var += diff
+        self.var *= np.float32(1 - alpha)
+
+    def dff(self, frame, noise_level=0, mask=None):
+        """ Get the relative change (frame - mean)/mean of a frame to the baseline (Delta F/F), with the pixels of
+        the baseline below noise_level divided by 100000 instead, multiplied by mask if given. """
+        return ratio_change(frame, self.mean, noise_level, mask)
+
+    def zscore(self, frame, mask=None):
+        """ Get the change of a frame to the baseline in units of the standard deviation of the baseline (z-score),
+        multiplied by mask if given. """
+        xp = array_module(frame)
+        z = xp.subtract(frame, self.mean, dtype=np.float32)
+        z /= xp.sqrt(xp.maximum(self.var, np.float32(self.min_std**2)))
+        if mask is not None:
+            z *= mask
+        return z
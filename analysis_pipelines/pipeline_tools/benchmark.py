@@ -0,0 +1,74 @@
+""" Timing of the per-pixel steps of the spike pipelines, of peak_local_max and of the whole CPU pipelines, with the
+NumPy kernels (the reference) and the numba kernels, with the default parameters of the pipelines, on frames of
+increasing size with a few spikes. Run from analysis_pipelines with: python -m pipeline_tools.benchmark """
+import sys
+import time
+from inspect import signature
+
+import numpy as np
+from scipy import ndimage as ndi
+
+from . import kernels
+from .peaks import peak_local_max
+
+def timeit(func, *args, repeats=20):
+    """ Best time (ms) of repeats calls of func, after a first call that compiles the numba kernels. """
+    func(*args)
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - t0)
+    return min(times) * 1e3
+
+
+def defaults(pipeline):
+    """ Default parameter values of a pipeline. """
+    return {name: param.default for name, param in signature(pipeline).parameters.items()}
+
+
+def scaling(pipeline):
+    """ Scaling of the analysis image of a spike pipeline (F_MULTIPLY of the pipeline its CPU version runs). """
+    return sys.modules[pipeline.__module__[:-len('_cpu')]].F_MULTIPLY
+
+
+def frames(size, rng, n_spikes=5):
+    """ A previous frame and a frame with n_spikes broad spikes of 50% relative change, on a background of 1000. """
+    prev_frame = rng.normal(1000, 30, (size, size)).astype(np.float32)
+    spikes = np.zeros((size, size), dtype=np.float32)
+    spikes[tuple(rng.integers(0, size, (2, n_spikes)))] = 1
+    spikes = ndi.gaussian_filter(spikes, 5)
+    img = prev_frame + rng.normal(0, 30, (size, size)).astype(np.float32) + 500 * spikes / spikes.max()
+    return img, prev_frame
+
+
+def main(sizes=(400, 800, 1024, 2048)):
+    import rapid_signal_spikes_cpu
+    import bapta_calcium_spikes_cpu
+    rng = np.random.default_rng(0)
+    use_numba = kernels.use_numba
+    print(f'numba available: {kernels.numba is not None}')
+    print(f'{"size":>6} {"pipeline":>24} {"kernel":>8} {"ratio":>8} {"clip":>8} {"peaks":>8} {"pipeline":>8}')
+    for size in sizes:
+        img, prev_frame = frames(size, rng)
+        mask = np.ones((size, size), dtype=np.float32)
+        for pipeline in (rapid_signal_spikes_cpu.rapid_signal_spikes_cpu, bapta_calcium_spikes_cpu.bapta_calcium_spikes_cpu):
+            params, f_multiply = defaults(pipeline), scaling(pipeline)
+            min_dist, thresh_abs = params['min_dist'], params['thresh_abs'] * f_multiply
+            img_peaks = kernels.clip_scale_numpy(ndi.gaussian_filter(
+                kernels.ratio_change_numpy(img, prev_frame, params['noise_level'], mask), params['smoothing_radius']), f_multiply)
+            for name, numba_on in (('numpy', False), ('numba', True)):
+                if numba_on and kernels.numba is None:
+                    continue
+                kernels.use_numba = numba_on
+                times = (timeit(kernels.ratio_change, img, prev_frame, params['noise_level'], mask),
+                         timeit(kernels.clip_scale, img_peaks, f_multiply),
+                         timeit(peak_local_max, img_peaks, min_dist, thresh_abs, None, params['border_limit'],
+                                params['num_peaks'], params['ensure_spacing'] == 1),
+                         timeit(pipeline, img, prev_frame[None], mask))
+                print(f'{size:>6} {pipeline.__name__:>24} {name:>8} ' + ' '.join(f'{t:8.2f}' for t in times) + ' ms')
+    kernels.use_numba = use_numba
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import numpy as np
+
+from .backend import array_module, to_host
+from .peaks import select_peaks
+
+
+def bin_image(img, factor):
+    """ Mean of the factor x factor blocks of an image (numpy or cupy) in float32, leaving out the last rows and
+    columns that do not fill a block. """
+    height, width = img.shape[0] // factor * factor, img.shape[1] // factor * factor
+    blocks = img[:height, :width].reshape(height // factor, factor, width // factor, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def unbin_image(img, factor, shape):
+    """ Expand a binned image to a full-resolution image of shape, repeating every value over its block. """
+    xp = array_module(img)
+    full = xp.zeros(shape, dtype=img.dtype)
+    full[:img.shape[0] * factor, :img.shape[1] * factor] = xp.repeat(xp.repeat(img, factor, axis=0), factor, axis=1)
+    return full
+
+
+def refine_peaks(analyse, candidates, factor, shape, halo, min_dist, thresh_abs, border_limit=0, num_peaks=None,
+                 spacing=False):
+    """
+    Refine the candidate peaks found in an image binned by factor ((row, col) in the binned image) to full
+    resolution, running the full-resolution analysis only in small windows around the candidates.
+    analyse(rows, cols) returns the analysis image of the full-resolution window at the slices rows and cols.
+    Each window covers the block of a candidate and its neighbouring blocks, extended by halo pixels on all sides
+    for the filters of analyse, and the maximum of the window without the halo is the refined peak. As in
+    peak_local_max, refined peaks above thresh_abs that are the maximum of their (2*min_dist+1)-sized square
+    neighbourhood (among the refined peaks) are kept.
+
+    Returns the (row, col) coordinates in the full-resolution image of shape of the num_peaks (all if None)
+    highest peaks, highest first. If spacing, peaks closer than min_dist to a higher peak are removed first.
+    """
+    candidates = np.asarray(candidates, dtype=np.int64).reshape(-1, 2)
+    coordinates = np.empty((len(candidates), 2), dtype=np.int64)
+    intensities = np.empty(len(candidates), dtype=np.float64)
+    for i, candidate in enumerate(candidates):
+        core = [(max(0, (c - 1) * factor), min(size, (c + 2) * factor)) for c, size in zip(candidate, shape)]
+        window = [(max(0, start - halo), min(size, stop + halo)) for (start, stop), size in zip(core, shape)]
+        img_ana = to_host(analyse(slice(*window[0]), slice(*window[1])))
+        img_core = img_ana[core[0][0] - window[0][0]:core[0][1] - window[0][0],
+                           core[1][0] - window[1][0]:core[1][1] - window[1][0]]
+        peak = np.unravel_index(np.argmax(img_core), img_core.shape)
+        coordinates[i] = (core[0][0] + peak[0], core[1][0] + peak[1])
+        intensities[i] = img_core[peak]
+    # candidates of the same peak, and peaks below the threshold
+    coordinates, first = np.unique(coordinates, axis=0, return_index=True)
+    intensities = intensities[first]
+    above = intensities > thresh_abs
+    coordinates, intensities = coordinates[above], intensities[above]
+    # maximum filter among the refined peaks
+    radius = int(2 * min_dist + 1) // 2
+    close = np.all(np.abs(coordinates[:, None] - coordinates[None]) <= radius, axis=2)
+    is_max = ~np.any(close & (intensities[None, :] > intensities[:, None]), axis=1)
+    return select_peaks(coordinates[is_max], intensities[is_max], shape, min_dist, border_limit, num_peaks, spacing)
@@ -0,0 +1,102 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+
+from .backend import get_backend, to_host
+
+_executor = ThreadPoolExecutor(max_workers=2)  # runs the independent filters of a stage concurrently, as OpenCV releases the GIL
+
+
+@functools.lru_cache(maxsize=32)
+def gaussian_kernel(sigma, truncate=4.0):
+    """ Get the 1D Gaussian kernel of sigma (float32) used by scipy.ndimage.gaussian_filter, created once per sigma. """
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / sigma**2 * x**2)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+@functools.lru_cache(maxsize=32)
+def box_sizes(sigma, n=3):
+    """ Get the odd sizes of n stacked box blurs approximating a Gaussian of sigma, created once per sigma. """
+    w = int(np.sqrt(12 * sigma**2 / n + 1))
+    w = w - 1 if w % 2 == 0 else w
+    m = round((12 * sigma**2 - n * w**2 - 4 * n * w - 3 * n) / (-4 * w - 4))
+    return tuple(w if i < m else w + 2 for i in range(n))
+
+
+class DoGStage:
+    """
+    Difference of Gaussians preprocessing: smoothing of the raw image (sigma_raw), difference of two Gaussians
+    of the smoothed image (sigma_lo - sigma_hi) with negative values set to 0, optional removal of values above
+    dog_max, scaling and masking, and a final smoothing (sigma_post). All filters are separable and run in float32
+    on scratch buffers kept between frames, on the array backend of the pipeline (numpy or cupy). On numpy, the
+    filters run in OpenCV with the sigma_lo and sigma_hi filters running concurrently.
+    If approx, the Gaussians of sigma 2 and above are approximated by three stacked box blurs, of constant cost
+    per pixel for any sigma, faster but less accurate.
+    """
+
+    def __init__(self, sigma_raw, sigma_lo, sigma_hi, sigma_post, approx=False):
+        self.sigmas = (sigma_raw, sigma_lo, sigma_hi, sigma_post)
+        self.approx = approx
+        self.__buffers = None  # float32 scratch buffers of the raw, smoothed, lo and hi images
+
+    def filter(self, src, dst, sigma, ndi=None):
+        """ Gaussian filter (or its box blur approximation) of src into dst, with the borders reflected as in scipy.ndimage.
+        In OpenCV for numpy arrays, otherwise with the given ndimage module. """
+        # small sigmas are left exact, as they are cheap and badly approximated by odd box sizes
+        approx = self.approx and sigma >= 2
+        if ndi is not None:
+            if approx:
+                for size in box_sizes(sigma):
+                    src = ndi.uniform_filter(src, size) if size > 1 else src
+                dst[...] = src
+            else:
+                ndi.gaussian_filter(src, sigma, output=dst)
+        elif approx:
+            dst[...] = src
+            for size in box_sizes(sigma):
+                if size > 1:
+                    cv2.blur(dst, (size, size), dst=dst, borderType=cv2.BORDER_REFLECT)
+        else:
+            kernel = gaussian_kernel(sigma)
+            cv2.sepFilter2D(src, cv2.CV_32F, kernel, kernel, dst=dst, borderType=cv2.BORDER_REFLECT)
+        return dst
+
+    def __call__(self, img, mask=None, scale=1, dog_max=None):
+        """ Get the preprocessed image of img (a new float32 array of the current backend), masked with mask if given. """
+        xp, ndi = get_backend()
+        if xp is np:
+            img, ndi = to_host(img), None
+        img = xp.asarray(img)
+        if self.__buffers is None or self.__buffers[0].shape != img.shape or not isinstance(self.__buffers[0], xp.ndarray):
+            self.__buffers = tuple(xp.empty(img.shape, dtype=xp.float32) for _ in range(4))
+        img_raw, img_filt, img_dog_lo, img_dog_hi = self.__buffers
+        sigma_raw, sigma_lo, sigma_hi, sigma_post = self.sigmas
+        img_raw[...] = img
+        self.filter(img_raw, img_filt, sigma_raw, ndi)
+        # difference of gaussians, with the two filters running concurrently on the CPU
+        if ndi is None:
+            hi = _executor.submit(self.filter, img_filt, img_dog_hi, sigma_hi)
+            self.filter(img_filt, img_dog_lo, sigma_lo)
+            hi.result()
+        else:
+            self.filter(img_filt, img_dog_hi, sigma_hi, ndi)
+            self.filter(img_filt, img_dog_lo, sigma_lo, ndi)
+        img_dog = xp.subtract(img_dog_lo, img_dog_hi, out=img_dog_lo)
+        xp.maximum(img_dog, 0, out=img_dog)
+        if dog_max is not None:
+            img_dog[img_dog > dog_max] = 0
+        if scale != 1:
+            img_dog *= scale
+        if mask is not None:
+            img_dog *= xp.asarray(mask)
+        return self.filter(img_dog, xp.empty(img.shape, dtype=xp.float32), sigma_post, ndi)
+
+
+@functools.lru_cache(maxsize=8)
+def dog_stage(sigma_raw, sigma_lo, sigma_hi, sigma_post, approx=False):
+    """ Get the DoG preprocessing stage of the given sigmas, created once per set of sigmas and kept between frames. """
+    return DoGStage(sigma_raw, sigma_lo, sigma_hi, sigma_post, approx)
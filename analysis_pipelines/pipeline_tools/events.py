@@ -0,0 +1,114 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .integral import box_sums
+from .trackstore import summarize_tracks
+
+
+def fusion_events(tracks, t_disappear, t_before, ves_dist, track_len_thresh, track_mov_thresh):
+    """
+    Fusion events of two tracks becoming one, evaluated for all tracks at once. The conditions are:
+    1. one track (#1) disappears at t_disappear, and is not seen after
+    2. another track (#2) is close by, inside ves_dist, in the last frames up to the disappearance (the first one found, in time order)
+    3. both tracks have more than track_len_thresh points between t_before and the disappearance
+    4. at least one track has moved a vectorial (start to end) distance above track_mov_thresh
+    5. at least one track has moved an accumulated absolute distance above track_mov_thresh
+
+    Returns the (y, x) coordinates of the last position of track #2 of each event, in the order of the disappearing tracks.
+    """
+    coords_events = np.empty((0,2))
+    tracks_timepoint = tracks.at(t_disappear)
+    tracks_timepoint_around = tracks.points(t_disappear-2, t_disappear)
+    tracks_after = tracks.points(t_min=t_disappear+1)
+    # (1) disappearing tracks
+    disappeared = ~np.isin(tracks_timepoint['particle'], tracks_after['particle'])
+    particle_ids_old1 = tracks_timepoint['particle'][disappeared]
+    coords_old1 = np.column_stack((tracks_timepoint['x'][disappeared], tracks_timepoint['y'][disappeared]))
+    coords_around = np.column_stack((tracks_timepoint_around['x'], tracks_timepoint_around['y']))
+    if len(coords_old1) == 0 or len(coords_around) == 0:
+        return coords_events
+    # (2) pairs of disappearing tracks and other tracks close by, keeping the first close-by point of each disappearing track
+    pairs = cKDTree(coords_old1).sparse_distance_matrix(cKDTree(coords_around), ves_dist, output_type='ndarray')
+    pairs = pairs[(pairs['v'] < ves_dist) & (particle_ids_old1[pairs['i']] != tracks_timepoint_around['particle'][pairs['j']])]
+    pairs = np.sort(pairs, order=('i', 'j'))
+    idx_old1, first = np.unique(pairs['i'], return_index=True)
+    particle_ids_old1 = particle_ids_old1[idx_old1]
+    particle_ids_old2 = tracks_timepoint_around['particle'][pairs['j'][first]]
+    # (3) number of points of both tracks before the disappearance
+    tracks_before = tracks.points(t_before, t_disappear-1)
+    self1 = summarize_tracks(tracks_before, particle_ids_old1)
+    self2 = summarize_tracks(tracks_before, particle_ids_old2)
+    long_enough = (self1['count'] > track_len_thresh) & (self2['count'] > track_len_thresh)
+    # (4) vectorial distance between the start and end integer positions of both tracks
+    def d_start_end(summary):
+        x_first, y_first, x_last, y_last = (np.trunc(np.nan_to_num(summary[name])) for name in ('x_first', 'y_first', 'x_last', 'y_last'))
+        return np.sqrt((x_first-x_last)**2 + (y_first-y_last)**2)
+    moved = (d_start_end(self1) > track_mov_thresh) | (d_start_end(self2) > track_mov_thresh)
+    # (5) accumulated absolute distance of both tracks
+    travelled = (self1['path_length'] > track_mov_thresh) | (self2['path_length'] > track_mov_thresh)
+    # event at the current position of track #2, if it is still there after the disappearance
+    current = summarize_tracks(tracks_after, particle_ids_old2)
+    event = long_enough & moved & travelled & (current['count'] > 0)
+    if np.any(event):
+        coords_events = np.column_stack((current['y_last'][event], current['x_last'][event])).astype(int).astype(float)
+    return coords_events
+
+
+def window_means(values, start, stop, width):
+    """ Mean of values[start:stop] for each pair of start and stop, with at most width values in between. """
+    idx = start[:, None] + np.arange(width)
+    inside = idx < stop[:, None]
+    sums = np.sum(np.where(inside, values[np.minimum(idx, len(values)-1)], 0), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums/np.sum(inside, axis=1)
+
+
+def appearance_events(tracks, prev_frames, t_appear, thresh_stayframes, thresh_intincratio, thresh_move_dist,
+                      intensity_sum_rad=3, meanlen=3):
+    """
+    Appearance events of tracks with a rising intensity, evaluated for all tracks at once. The conditions are:
+    1. the track appears at t_appear
+    2. the track stays for more than thresh_stayframes frames after t_appear
+    3. the intensity around the last position of the track, in the first meanlen of prev_frames (before), the
+    first meanlen points of the track (init) and the meanlen points before its last (last), increases from
+    before to init, init to last or before to last with a ratio above thresh_intincratio
+    4. the track has moved less than thresh_move_dist between its first point after t_appear and its last point
+
+    Returns the integer (row, col) coordinates of the last position of the tracks of all events and their
+    intensity increase ratios (before to init, init to last, before to last), ranked by the highest ratio.
+    """
+    tracks_timepoint = tracks.at(t_appear)
+    # (1) appearing tracks, not seen before t_appear
+    particle_ids = tracks_timepoint['particle'][~np.isin(tracks_timepoint['particle'], tracks.points(t_max=t_appear-1)['particle'])]
+    # points after t_appear, grouped per track in time order
+    tracks_after = tracks.points(t_min=t_appear+1)
+    order = np.argsort(tracks_after['particle'], kind='stable')
+    tracks_after = {name: col[order] for name, col in tracks_after.items()}
+    ids, first, count = np.unique(tracks_after['particle'], return_index=True, return_counts=True)
+    # (2) tracks staying for more than thresh_stayframes frames
+    pos = np.searchsorted(ids, particle_ids)
+    found = pos < len(ids)
+    found[found] = ids[pos[found]] == particle_ids[found]
+    pos = pos[found]
+    pos = pos[count[pos] > thresh_stayframes]
+    first, last = first[pos], first[pos] + count[pos] - 1
+    coords_last = np.column_stack((tracks_after['x'][last], tracks_after['y'][last])).astype(int)
+    coords_first = np.column_stack((tracks_after['x'][first], tracks_after['y'][first])).astype(int)
+    # (3) intensity increase, with the intensities before the appearance summed in the previous frames in one batch
+    if np.ndim(prev_frames) == 3 and len(prev_frames) > 0:
+        int_before = np.mean(box_sums(prev_frames, coords_last, intensity_sum_rad, t=slice(0, meanlen))/(2*intensity_sum_rad+1)**2, axis=0)
+    else:
+        int_before = np.full(len(pos), np.nan)
+    intensity = tracks_after['intensity']
+    int_init = window_means(intensity, first, last+1, meanlen)
+    int_last = window_means(intensity, np.maximum(first, last-meanlen), last, meanlen)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratios = np.column_stack((int_init/int_before, int_last/int_init, int_last/int_before))
+    increased = np.any(ratios > thresh_intincratio, axis=1)
+    # (4) tracks that have not moved too much since they appeared
+    d_start_end = np.sqrt(np.sum((coords_first - coords_last)**2, axis=1))
+    event = increased & (d_start_end < thresh_move_dist)
+    # rank the events by their highest intensity increase ratio
+    coords_last, ratios = coords_last[event], ratios[event]
+    rank = np.argsort(-np.nanmax(ratios, axis=1), kind='stable')
+    return coords_last[rank], ratios[rank]
@@ -0,0 +1,45 @@
+import numpy as np
+
+
+def integral_image(frames):
+    """ Summed-area table(s) of a frame or a stack of frames (H x W or T x H x W), with a leading row and
+    column of zeros, exact (int64) for integer frames. A cupy frame is moved to the host once. """
+    if hasattr(frames, 'get'):
+        frames = frames.get()
+    frames = np.asarray(frames)
+    dtype = np.int64 if np.issubdtype(frames.dtype, np.integer) else np.float64
+    integrals = np.zeros((*frames.shape[:-2], frames.shape[-2] + 1, frames.shape[-1] + 1), dtype=dtype)
+    np.cumsum(frames, axis=-2, dtype=dtype, out=integrals[..., 1:, 1:])
+    np.cumsum(integrals[..., 1:, 1:], axis=-1, out=integrals[..., 1:, 1:])
+    return integrals
+
+
+def box_sums(frames, coords, radius, t=slice(None)):
+    """
+    Sum the (2*radius+1)-sized square windows around coords (N x 2, integer row and column) in a frame
+    (H x W) or in the frames t of a stack (T x H x W), leaving out the pixels outside the frames. With the
+    summed-area tables kept with the frames of the frame history (frames.integrals), every sum is four
+    lookups in the tables. Otherwise the windows are summed directly, as building the tables of whole frames
+    costs more than summing a few windows.
+
+    Returns the sums as an array of N values, or of T x N values (a time series per coordinate) for a stack.
+    """
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+    integrals = getattr(frames, 'integrals', None)
+    height, width = np.shape(frames)[-2:]
+    r0 = np.clip(coords[:, 0] - radius, 0, height)
+    r1 = np.clip(coords[:, 0] + radius + 1, 0, height)
+    c0 = np.clip(coords[:, 1] - radius, 0, width)
+    c1 = np.clip(coords[:, 1] + radius + 1, 0, width)
+    if integrals is None:
+        if hasattr(frames, 'get'):
+            frames = frames.get()
+        frames = np.asarray(frames if np.ndim(frames) == 2 else frames[t])
+        dtype = np.int64 if np.issubdtype(frames.dtype, np.integer) else np.float64
+        sums = np.empty((*frames.shape[:-2], len(coords)), dtype=dtype)
+        for i in range(len(coords)):
+            sums[..., i] = frames[..., r0[i]:r1[i], c0[i]:c1[i]].sum(axis=(-2, -1), dtype=dtype)
+        return sums
+    if np.ndim(frames) == 3:
+        integrals = integrals[t]
+    return integrals[..., r1, c1] - integrals[..., r0, c1] - integrals[..., r1, c0] + integrals[..., r0, c0]
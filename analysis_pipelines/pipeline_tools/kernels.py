@@ -0,0 +1,89 @@
+""" Optional numba-compiled CPU kernels of the elementwise per-pixel work of the spike pipelines, each doing its
+work in a single parallel pass over the image, without temporary arrays. Without numba (or with use_numba set to
+False), the NumPy versions are used. The maximum filter of peak_local_max stays with cv2.dilate, whose cost does
+not grow with the neighbourhood size as a per-pixel neighbourhood scan does. """
+import numpy as np
+
+from .backend import array_module
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+use_numba = numba is not None  # run the numba kernels, if numba is installed
+
+
+def ratio_change_numpy(img, prev_frame, noise_level, mask=None):
+    """ NumPy (or cupy) version of ratio_change. """
+    xp = array_module(img)
+    img_ana = xp.subtract(img, prev_frame, dtype=np.float32)
+    # replace noise with a very high value to avoid detecting noise
+    img_div = xp.where(prev_frame < noise_level, np.float32(100000), prev_frame).astype(np.float32, copy=False)
+    img_ana = xp.true_divide(img_ana, img_div)
+    if mask is not None:
+        img_ana = img_ana * mask
+    return img_ana.astype(np.float32, copy=False)
+
+
+def clip_scale_numpy(img_ana, scale):
+    """ NumPy (or cupy) version of clip_scale. """
+    xp = array_module(img_ana)
+    img_ana = xp.clip(img_ana, a_min=0, a_max=None)
+    return (img_ana * scale).astype(np.float32)
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=False, cache=True)
+    def _ratio_change(img, prev_frame, noise_level, mask, use_mask, out):
+        for i in numba.prange(img.shape[0]):
+            for j in range(img.shape[1]):
+                prev = np.float32(prev_frame[i, j])
+                diff = np.float32(img[i, j]) - prev
+                div = np.float32(100000) if prev < noise_level else prev
+                value = diff / div
+                if use_mask:
+                    value = value * mask[i, j]
+                out[i, j] = value
+        return out
+
+    @numba.njit(parallel=True, cache=True)
+    def _clip_scale(img_ana, scale, out):
+        for i in numba.prange(img_ana.shape[0]):
+            for j in range(img_ana.shape[1]):
+                value = img_ana[i, j]
+                out[i, j] = (np.float32(0) if value < 0 else value) * scale
+        return out
+
+    def ratio_change_numba(img, prev_frame, noise_level, mask=None):
+        img, prev_frame = np.asarray(img), np.asarray(prev_frame)
+        use_mask = mask is not None
+        mask = np.asarray(mask) if use_mask else np.ones((1, 1), dtype=np.float32)
+        # the kernel does not check its indices: refuse arrays the NumPy version would fail to broadcast as well
+        if img.ndim != 2:
+            raise ValueError(f'ratio_change expects a 2D image, got shape {img.shape}')
+        if prev_frame.shape != img.shape:
+            raise ValueError(f'shape of previous frame {prev_frame.shape} does not match image {img.shape}')
+        if use_mask and mask.shape != img.shape:
+            raise ValueError(f'shape of mask {mask.shape} does not match image {img.shape}')
+        if np.ndim(noise_level) != 0:
+            raise ValueError(f'ratio_change expects a scalar noise level, got shape {np.shape(noise_level)}')
+        out = np.empty(img.shape, dtype=np.float32)
+        return _ratio_change(img, prev_frame, np.float32(noise_level), mask, use_mask, out)
+
+    def clip_scale_numba(img_ana, scale):
+        return _clip_scale(img_ana, np.float32(scale), np.empty(img_ana.shape, dtype=np.float32))
+
+def ratio_change(img, prev_frame, noise_level, mask=None):
+    """ Ratiometric change (img - prev_frame)/prev_frame in float32, with the pixels of prev_frame below noise_level
+    divided by 100000 instead to avoid detecting noise, multiplied by mask if given. """
+    if use_numba and isinstance(img, np.ndarray):
+        return ratio_change_numba(img, prev_frame, noise_level, mask)
+    return ratio_change_numpy(img, prev_frame, noise_level, mask)
+
+
+def clip_scale(img_ana, scale):
+    """ Clip img_ana to non-negative values and scale it, in float32. """
+    if use_numba and isinstance(img_ana, np.ndarray):
+        return clip_scale_numba(img_ana, scale)
+    return clip_scale_numpy(img_ana, scale)
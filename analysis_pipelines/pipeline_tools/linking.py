@@ -0,0 +1,79 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+
+class StreamingLinker:
+    """ Online particle linker, linking only the particles of each new frame to the active tracks,
+    with the search_range and memory of trackpy.link. A track stays active at its last position
+    for memory frames after it was last seen. Competing links are resolved per subnetwork as in
+    trackpy, minimizing the summed squared displacements, where leaving a track unlinked counts as
+    a displacement of search_range. The cost per frame only depends on the number of particles in
+    the new frame and the active tracks, and the particle ids are kept for the lifetime of a track. """
+
+    def __init__(self, search_range, memory=0):
+        self.search_range = search_range
+        self.memory = int(memory)
+        self.reset()
+
+    def reset(self):
+        """ Drop all tracks. """
+        self.__pos = np.empty((0, 2))  # last position of the active tracks
+        self.__ids = np.empty(0, dtype=np.int64)  # particle ids of the active tracks
+        self.__last_t = np.empty(0, dtype=np.int64)  # frame the active tracks were last seen in
+        self.__next_id = 0
+
+    def link(self, coords, t):
+        """ Link the particles at coords (N x 2) in frame t to the active tracks, and get their particle ids. """
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        # drop the tracks that have been gone for longer than the memory
+        active = t - self.__last_t <= self.memory + 1
+        pos, ids, last_t = self.__pos[active], self.__ids[active], self.__last_t[active]
+        particle_ids = np.full(len(coords), -1, dtype=np.int64)
+        linked = np.zeros(len(pos), dtype=bool)
+        if len(pos) and len(coords):
+            src, dst = self.assign(pos, coords)
+            particle_ids[dst] = ids[src]
+            linked[src] = True
+        # new tracks for the particles not linked
+        new = particle_ids < 0
+        particle_ids[new] = np.arange(self.__next_id, self.__next_id + np.count_nonzero(new))
+        self.__next_id += np.count_nonzero(new)
+        self.__pos = np.concatenate((pos[~linked], coords))
+        self.__ids = np.concatenate((ids[~linked], particle_ids))
+        self.__last_t = np.concatenate((last_t[~linked], np.full(len(coords), t, dtype=np.int64)))
+        return particle_ids
+
+    def assign(self, pos, coords):
+        """ Get the indices of the linked tracks and particles, solving each subnetwork of competing links separately. """
+        dist = cKDTree(pos).sparse_distance_matrix(cKDTree(coords), self.search_range, output_type='ndarray')
+        src, dst, d = dist['i'], dist['j'], dist['v']
+        if len(src) == 0:
+            return src, dst
+        # subnetworks: connected components of the graph of candidate links between tracks and particles
+        n_pos = len(pos)
+        graph = coo_matrix((np.ones(len(src)), (src, n_pos + dst)), shape=(n_pos + len(coords),)*2)
+        _, labels = connected_components(graph, directed=False)
+        comp = labels[src]
+        n_links = np.bincount(comp, minlength=labels.max() + 1)
+        # subnetworks of a single candidate link are linked directly
+        single = n_links[comp] == 1
+        src_linked, dst_linked = [src[single]], [dst[single]]
+        for c in np.unique(comp[~single]):
+            in_comp = comp == c
+            s_sub, s_idx = np.unique(src[in_comp], return_inverse=True)
+            d_sub, d_idx = np.unique(dst[in_comp], return_inverse=True)
+            # squared displacements, with one option per track of leaving it unlinked
+            unlinked = self.search_range**2
+            blocked = unlinked*len(s_sub) + 1  # more than leaving all tracks unlinked, never chosen
+            cost = np.full((len(s_sub), len(d_sub) + len(s_sub)), blocked, dtype=np.float64)
+            cost[s_idx, d_idx] = d[in_comp]**2
+            cost[np.arange(len(s_sub)), len(d_sub) + np.arange(len(s_sub))] = unlinked
+            rows, cols = linear_sum_assignment(cost)
+            keep = cols < len(d_sub)
+            rows, cols = rows[keep], cols[keep]
+            src_linked.append(s_sub[rows])
+            dst_linked.append(d_sub[cols])
+        return np.concatenate(src_linked), np.concatenate(dst_linked)
@@ -0,0 +1,122 @@
+import functools
+import numpy as np
+import cv2
+
+_buffers = dict()  # (image shape, dtype): scratch buffers of the maximum filtered image and peak masks
+_max_buffers = 8  # number of image shapes and dtypes to keep scratch buffers for
+_dilate_dtypes = [np.dtype(dtype) for dtype in (np.uint8, np.uint16, np.int16, np.float32, np.float64)]  # dtypes supported by cv2.dilate
+
+
+@functools.lru_cache(maxsize=16)
+def structuring_element(size):
+    """ Get the square structuring element of a side size, created once per size. """
+    return cv2.getStructuringElement(cv2.MORPH_RECT, ksize=[size, size])
+
+
+def get_buffers(shape, dtype):
+    """ Get the scratch buffers for images of a shape and dtype, allocated once per shape and dtype. """
+    key = (tuple(shape), np.dtype(dtype))
+    buffers = _buffers.get(key)
+    if buffers is None:
+        if len(_buffers) >= _max_buffers:
+            _buffers.clear()
+        buffers = _buffers[key] = (np.empty(shape, dtype=dtype), np.empty(shape, dtype=bool), np.empty(shape, dtype=bool))
+    return buffers
+
+
+def in_bounds(coordinates, shape, border_limit):
+    """ Get a boolean mask of the coordinates not closer to the border than border_limit pixels. """
+    shape = np.asarray(shape[:2])
+    return np.all((coordinates >= border_limit) & (coordinates <= shape - border_limit), axis=1)
+
+
+def top_k(intensities, k=None):
+    """ Get the indices of the k highest intensities (all if k is None), highest first. """
+    if k is not None and len(intensities) > int(k):
+        k = int(k)
+        idx = np.argpartition(-intensities, k - 1)[:k] if k > 0 else np.empty(0, dtype=np.intp)
+        return idx[np.argsort(-intensities[idx])]
+    return np.argsort(-intensities)
+
+
+def ensure_spacing(coordinates, min_dist, block_size=512):
+    """ Greedily remove the peaks closer than min_dist (Chebyshev distance) to a kept higher peak,
+    with integer pixel coordinates sorted with the highest peak first. The peaks are handled in blocks
+    of block_size in order: peaks close to a peak kept in an earlier block are looked up in a suppression
+    image, and the rest are compared pairwise within the block, so that only the peaks close to each
+    other in the same block are resolved one by one. """
+    coordinates = np.asarray(coordinates)
+    radius = int(np.ceil(min_dist)) - 1  # largest integer distance closer than min_dist
+    if len(coordinates) < 2 or radius < 1:
+        return coordinates
+    coords = (coordinates - coordinates.min(axis=0)).astype(np.int32)
+    shape = tuple(coords.max(axis=0) + 1)
+    suppressed = np.zeros(shape, dtype=np.uint8)
+    seeds = np.zeros(shape, dtype=np.uint8)
+    footprint = structuring_element(2 * radius + 1)
+    keep = np.zeros(len(coords), dtype=bool)
+    for start in range(0, len(coords), block_size):
+        block = coords[start:start + block_size]
+        # peaks not close to any peak kept in an earlier block
+        idx = np.flatnonzero(suppressed[block[:, 0], block[:, 1]] == 0)
+        block = block[idx]
+        # pairs of close peaks in the block, from the higher to the lower peak
+        close = np.abs(block[:, 0, None] - block[None, :, 0]) <= radius
+        close &= np.abs(block[:, 1, None] - block[None, :, 1]) <= radius
+        close = np.triu(close, k=1)
+        alive = np.ones(len(block), dtype=bool)
+        for i in np.flatnonzero(close.any(axis=1)):
+            if alive[i]:
+                alive &= ~close[i]
+        kept = block[alive]
+        keep[start + idx[alive]] = True
+        if len(kept) and start + block_size < len(coords):
+            # suppress the neighbourhoods of the kept peaks for the following blocks
+            seeds[kept[:, 0], kept[:, 1]] = 1
+            suppressed |= cv2.dilate(seeds, kernel=footprint)
+            seeds[kept[:, 0], kept[:, 1]] = 0
+    return coordinates[keep]
+
+
+def peak_local_max(img_ana, min_dist, thresh_abs, thresh_abs_hi=None, border_limit=0, num_peaks=None, spacing=False):
+    """
+    Peak_local_max all-in-one as a combo of opencv and numpy. Finds the pixels that are the maximum
+    of their (2*min_dist+1)-sized square neighbourhood, above thresh_abs (and below thresh_abs_hi),
+    and not closer to the border than border_limit pixels. A cupy image is moved to the host once.
+    Structuring elements and scratch buffers are reused between calls.
+
+    Returns the (row, col) coordinates of the num_peaks (all if None) highest peaks, highest first.
+    If spacing, peaks closer than min_dist to a higher peak are removed before the border and number limits.
+    """
+    if hasattr(img_ana, 'get'):
+        img_ana = img_ana.get()
+    img_ana = np.ascontiguousarray(img_ana)
+    if img_ana.dtype not in _dilate_dtypes:
+        img_ana = img_ana.astype(np.float64)
+    image_max, mask, mask_thresh = get_buffers(img_ana.shape, img_ana.dtype)
+    # maximum filter (dilation + equal)
+    cv2.dilate(img_ana, kernel=structuring_element(int(2 * min_dist + 1)), dst=image_max)
+    np.equal(img_ana, image_max, out=mask)
+    mask &= np.greater(img_ana, thresh_abs, out=mask_thresh)
+    if thresh_abs_hi is not None:
+        mask &= np.less(img_ana, thresh_abs_hi, out=mask_thresh)
+    # get coordinates and intensities of peaks
+    coordinates = np.argwhere(mask)
+    intensities = img_ana[mask]
+    return select_peaks(coordinates, intensities, img_ana.shape, min_dist, border_limit, num_peaks, spacing)
+
+
+def select_peaks(coordinates, intensities, shape, min_dist, border_limit=0, num_peaks=None, spacing=False):
+    """ Get the (row, col) coordinates of the num_peaks (all if None) highest peaks, highest first, not closer to the
+    border of an image of shape than border_limit pixels. If spacing, peaks closer than min_dist to a higher peak
+    are removed before the border and number limits. """
+    intensities = np.asarray(intensities).astype(np.float64)  # signed, to sort unsigned images correctly
+    if spacing:
+        # spacing needs all peaks in order, highest first
+        coordinates = ensure_spacing(coordinates[np.argsort(-intensities)], min_dist)
+        coordinates = coordinates[in_bounds(coordinates, shape, border_limit)]
+        return coordinates if num_peaks is None else coordinates[:int(num_peaks)]
+    # remove everything on the border, and select the highest peaks without sorting all of them
+    inside = in_bounds(coordinates, shape, border_limit)
+    coordinates, intensities = coordinates[inside], intensities[inside]
+    return coordinates[top_k(intensities, num_peaks)]
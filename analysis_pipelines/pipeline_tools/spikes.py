@@ -0,0 +1,146 @@
+""" The spike pipelines (rapid_signal_spikes and bapta_calcium_spikes), differing only in their default parameters
+and the scaling of their analysis images, and their analysis images: the ratiometric change of the current frame
+to the previous frame or to a running baseline, smoothed, clipped and scaled. """
+import logging
+
+import numpy as np
+
+from .backend import get_backend, to_host
+from .kernels import ratio_change, clip_scale
+from .coarse import bin_image, unbin_image, refine_peaks
+from .peaks import peak_local_max
+from .background import BackgroundCache, RunningBaseline, frame_ids
+
+logger = logging.getLogger(__name__)
+
+
+def analysis_image(img, prev_frame, binary_mask, noise_level, smoothing_radius, init_smooth, f_multiply, background=None,
+                   factor=1, ids=(None, None)):
+    """ Get the ratiometric change of img to prev_frame, binned by factor, smoothed, clipped to positive values and
+    scaled by f_multiply. The smoothed (binned) img is kept in background, if given, and reused as the smoothed
+    prev_frame of the next frame, so that every frame is filtered once. ids are the sequence numbers of prev_frame
+    and img (frame_ids), identifying the frames in background. """
+    xp, ndi = get_backend()
+
+    def prepare(frame):
+        frame = xp.asarray(frame, dtype='float32') if factor == 1 else bin_image(xp.asarray(frame), factor)
+        return ndi.gaussian_filter(frame, 2*smoothing_radius) if init_smooth==1 else frame
+
+    # initial smoothing of the raw images, of only the current frame if the previous one was kept from the last frame
+    key = (factor, smoothing_radius, init_smooth)
+    prev_id, img_id = ids
+    prev_ana = background.get(prev_id, key) if background is not None else None
+    if prev_ana is None:
+        prev_ana = prepare(prev_frame)
+    img_ana = prepare(img)
+    if background is not None and (init_smooth==1 or factor > 1):
+        background.keep(img_id, key, img_ana)
+
+    # subtract last img and divide by last image to get percentual change in img, replacing noise in
+    # the last image with a very high value to avoid detecting noise, in one pass (compiled if numba is available)
+    img_ana = ratio_change(img_ana, prev_ana, noise_level, None if binary_mask is None else xp.asarray(binary_mask))
+
+    img_ana = ndi.gaussian_filter(img_ana, smoothing_radius)  # Gaussian filter the image, to remove noise and so on, to get a better center estimate
+    return clip_scale(img_ana, f_multiply)
+
+
+def baseline_image(img, baseline, binary_mask, noise_level, smoothing_radius, init_smooth, f_multiply, zscore=False):
+    """ Get the change of img relative to a running baseline of the previous frames (Delta F/F, with the baseline below
+    noise_level replaced by a very high value), or in units of its standard deviation if zscore, smoothed, clipped to
+    positive values and scaled by f_multiply, and add img to the baseline. Zero until the baseline has two frames. """
+    xp, ndi = get_backend()
+    img = xp.asarray(img, dtype='float32')
+    if init_smooth==1:
+        img = ndi.gaussian_filter(img, 2*smoothing_radius)
+    mask = None if binary_mask is None else xp.asarray(binary_mask)
+    if baseline.count < 2 or baseline.mean.shape != img.shape:
+        img_ana = xp.zeros(img.shape, dtype='float32')
+    elif zscore:
+        img_ana = baseline.zscore(img, mask)
+    else:
+        img_ana = baseline.dff(img, noise_level, mask)
+    baseline.update(img)
+
+    img_ana = ndi.gaussian_filter(img_ana, smoothing_radius)  # Gaussian filter the image, to remove noise and so on, to get a better center estimate
+    return clip_scale(img_ana, f_multiply)
+
+
+def spike_pipeline(img, prev_frames, binary_mask, testmode, exinfo, f_multiply, min_dist, thresh_abs, num_peaks,
+                   noise_level, smoothing_radius, ensure_spacing, border_limit, init_smooth, coarse_bin,
+                   background_model, baseline_alpha, thresh_z):
+    """
+    Common parameters:
+    img - current image,
+    prev_frames - previous image(s)
+    binary_mask - binary mask of the region to consider
+    testmode - to return preprocessed image or not
+    exinfo - the smoothed frame of the last call, reused as the smoothed previous frame (BackgroundCache, identified by the frame sequence numbers of prev_frames), and the running baseline
+
+    Pipeline specific parameters:
+    f_multiply - scaling of the analysis image img_ana, with thresh_abs and thresh_z in the unscaled units
+    min_dist - minimum distance in pixels between two peaks
+    thresh_abs - low intensity threshold in img_ana of the peaks to consider
+    num_peaks - number of peaks to track
+    noise_level - noise level of not wanted signal, to avoid peak detection of potentially high ratiometric background noise
+    smoothing_radius - diameter of Gaussian smoothing of img_ana, in pixels
+    ensure_spacing - to ensure spacing between detected peaks or not (bool 0/1)
+    border_limit - how much of the border to remove peaks from in pixels
+    init_smooth - if to perform an initial smoothing of the raw image or not (bool 0/1)
+    coarse_bin - binning factor of a coarse pre-screen (1 for none, 2 or 4): candidate peaks are found in the binned images,
+                 and the full-resolution analysis is only run in small windows around them
+    background_model - background of the ratiometric change: 0 for the previous frame, or a running baseline of the previous
+                       frames (ignoring coarse_bin) with 1 for the change relative to the baseline (Delta F/F) and 2 for
+                       the change in units of the standard deviation of the baseline (z-score, thresholded with thresh_z)
+    baseline_alpha - weight of the newest frame in the running baseline, ~1/(number of frames averaged)
+    thresh_z - threshold of the smoothed z-score in standard deviations of the baseline, used instead of thresh_abs with
+               background_model 2
+    """
+
+    xp, ndi = get_backend()
+    if binary_mask is None or np.shape(binary_mask) != np.shape(img):
+        binary_mask = None
+    if exinfo is None:
+        exinfo = {'background': BackgroundCache(), 'baseline': RunningBaseline(baseline_alpha)}
+    if int(background_model) > 0:
+        # change relative to the running baseline of the previous frames, with the current frame added to it after
+        baseline = exinfo['baseline']
+        baseline.alpha = baseline_alpha
+        img_ana = baseline_image(img, baseline, binary_mask, noise_level, smoothing_radius, init_smooth, f_multiply,
+                                 zscore=int(background_model)==2)
+        thresh = thresh_z if int(background_model)==2 else thresh_abs
+        # peak_local_max, with the highest peaks first, removing peaks on the border and down to a certain number
+        coordinates = peak_local_max(img_ana, min_dist, thresh*f_multiply, border_limit=border_limit,
+                                     num_peaks=num_peaks, spacing=ensure_spacing==1)
+    elif prev_frames is None or len(prev_frames) == 0 or np.shape(img) != np.shape(prev_frames[-1]):
+        logger.warning('You have to provide a background image for this pipeline.')
+        img_ana = xp.zeros(np.shape(img), dtype='float32')
+        coordinates = peak_local_max(img_ana, min_dist, thresh_abs*f_multiply, border_limit=border_limit,
+                                     num_peaks=num_peaks, spacing=ensure_spacing==1)
+    elif int(coarse_bin) > 1:
+        # coarse-to-fine: candidate peaks in the binned images, above half the threshold and at a spacing of half min_dist,
+        # refined in full-resolution windows around them, with a halo covering the Gaussian filters (truncated at 4 sigma)
+        factor = int(coarse_bin)
+        img, prev_frame = xp.asarray(img), xp.asarray(prev_frames[-1])
+        mask = None if binary_mask is None else xp.asarray(binary_mask, dtype='float32')
+        img_bin = analysis_image(img, prev_frame, None if mask is None else bin_image(mask, factor), noise_level,
+                                 smoothing_radius/factor, init_smooth, f_multiply, exinfo['background'], factor,
+                                 frame_ids(prev_frames))
+        candidates = peak_local_max(img_bin, max(1, min_dist/(2*factor)), thresh_abs*f_multiply/2, num_peaks=4*num_peaks)
+        halo = int(8*smoothing_radius + 0.5)*(init_smooth==1) + int(4*smoothing_radius + 0.5) + 1
+        analyse = lambda rows, cols: analysis_image(img[rows, cols], prev_frame[rows, cols],
+                                                    None if mask is None else mask[rows, cols], noise_level,
+                                                    smoothing_radius, init_smooth, f_multiply)
+        coordinates = refine_peaks(analyse, candidates, factor, np.shape(img), halo, min_dist, thresh_abs*f_multiply,
+                                   border_limit=border_limit, num_peaks=num_peaks, spacing=ensure_spacing==1)
+        img_ana = unbin_image(img_bin, factor, np.shape(img)) if testmode else None
+    else:
+        img_ana = analysis_image(img, prev_frames[-1], binary_mask, noise_level, smoothing_radius, init_smooth, f_multiply,
+                                 exinfo['background'], ids=frame_ids(prev_frames))
+        # peak_local_max, with the highest peaks first, removing peaks on the border and down to a certain number
+        coordinates = peak_local_max(img_ana, min_dist, thresh_abs*f_multiply, border_limit=border_limit,
+                                     num_peaks=num_peaks, spacing=ensure_spacing==1)
+
+    if testmode:
+        return coordinates, exinfo, to_host(img_ana)
+    else:
+        return coordinates, exinfo
@@ -0,0 +1,146 @@
+import numpy as np
+
+
+class TrackStore:
+    """ Track history of the last n_frames time points, in fixed-capacity numpy columns (particle,
+    t and the given columns) with one row of slots per time point in a ring. The points of a time
+    point and the history of a particle are looked up through the time slots and a particle index,
+    without searching the whole store, and the oldest time point is dropped when a new one is added. """
+
+    def __init__(self, n_frames, max_points=256, columns=('x', 'y')):
+        self.n_frames = int(n_frames)
+        self.max_points = int(max_points)
+        self.columns = tuple(columns)
+        self.__t = np.full(self.n_frames, -1, dtype=np.int64)  # time point of each slot, -1 if empty
+        self.__count = np.zeros(self.n_frames, dtype=np.int64)  # number of points in each slot
+        self.__particle = np.zeros((self.n_frames, self.max_points), dtype=np.int64)
+        self.__data = {name: np.zeros((self.n_frames, self.max_points)) for name in self.columns}
+        # particle index: row of each particle, and the position of its point in each slot (-1 if none)
+        capacity = self.n_frames*self.max_points
+        self.__rows = dict()
+        self.__row = np.zeros((self.n_frames, self.max_points), dtype=np.int64)  # particle row of each point
+        self.__index = np.full((capacity, self.n_frames), -1, dtype=np.int32)
+        self.__npoints = np.zeros(capacity, dtype=np.int64)
+        self.__free = list(range(capacity - 1, -1, -1))
+        self.t_last = -1  # last added time point
+
+    def __len__(self):
+        return int(np.sum(self.__count))
+
+    def add(self, t, particle, **columns):
+        """ Add the points of a new time point t (later than the last one), with their particle ids and column values. """
+        t = int(t)
+        if t <= self.t_last:
+            raise ValueError(f'Time point {t} is not after the last time point {self.t_last}')
+        particle = np.asarray(particle, dtype=np.int64).ravel()
+        if len(particle) > self.max_points:
+            raise ValueError(f'More points ({len(particle)}) than max_points ({self.max_points})')
+        # drop the time points falling out of the window, including skipped time points
+        for t_new in range(max(self.t_last + 1, t - self.n_frames + 1), t + 1):
+            self.evict(t_new % self.n_frames)
+            self.__t[t_new % self.n_frames] = t_new
+        slot = t % self.n_frames
+        n = len(particle)
+        self.__count[slot] = n
+        self.__particle[slot, :n] = particle
+        for name in self.columns:
+            self.__data[name][slot, :n] = columns[name]
+        for i, p in enumerate(particle.tolist()):
+            row = self.__rows.get(p)
+            if row is None:
+                row = self.__rows[p] = self.__free.pop()
+            self.__row[slot, i] = row
+        rows = self.__row[slot, :n]
+        self.__index[rows, slot] = np.arange(n)
+        self.__npoints[rows] += 1
+        self.t_last = t
+
+    def evict(self, slot):
+        """ Drop the points of a slot, and the particles left without points. """
+        n = self.__count[slot]
+        if n > 0:
+            rows = self.__row[slot, :n]
+            self.__index[rows, slot] = -1
+            self.__npoints[rows] -= 1
+            for i in np.flatnonzero(self.__npoints[rows] == 0):
+                del self.__rows[int(self.__particle[slot, i])]
+                self.__free.append(int(rows[i]))
+        self.__count[slot] = 0
+        self.__t[slot] = -1
+
+    def at(self, t):
+        """ Get the points of time point t, as a dictionary of column views including 'particle'. """
+        slot = int(t) % self.n_frames
+        n = self.__count[slot] if self.__t[slot] == t else 0
+        points = {'particle': self.__particle[slot, :n]}
+        points.update({name: self.__data[name][slot, :n] for name in self.columns})
+        return points
+
+    def history(self, particle, t_min=None, t_max=None):
+        """ Get the points of a particle between t_min and t_max (inclusive, all if None) in time order,
+        as a dictionary of columns including 't'. """
+        times = np.arange(self.t_last - self.n_frames + 1, self.t_last + 1)
+        if t_min is not None:
+            times = times[times >= t_min]
+        if t_max is not None:
+            times = times[times <= t_max]
+        row = self.__rows.get(int(particle))
+        if row is None or len(times) == 0:
+            times = times[:0]
+            idx = np.empty(0, dtype=np.int32)
+        else:
+            slots = times % self.n_frames
+            idx = self.__index[row, slots]
+            present = (idx >= 0) & (self.__t[slots] == times)
+            times, idx = times[present], idx[present]
+        slots = times % self.n_frames
+        points = {'t': times}
+        points.update({name: self.__data[name][slots, idx] for name in self.columns})
+        return points
+
+    def points(self, t_min=None, t_max=None):
+        """ Get the points between t_min and t_max (inclusive, all if None) in time order, as a dictionary of columns including 'particle' and 't'. """
+        times = np.arange(self.t_last - self.n_frames + 1, self.t_last + 1)
+        if t_min is not None:
+            times = times[times >= t_min]
+        if t_max is not None:
+            times = times[times <= t_max]
+        slots = times % self.n_frames
+        counts = np.where(self.__t[slots] == times, self.__count[slots], 0)
+        present = np.arange(self.max_points) < counts[:, None]
+        points = {'particle': self.__particle[slots][present], 't': np.repeat(times, counts)}
+        points.update({name: self.__data[name][slots][present] for name in self.columns})
+        return points
+
+    def particles(self, t_min=None, t_max=None):
+        """ Get the unique particle ids of the points between t_min and t_max (inclusive, all if None). """
+        return np.unique(self.points(t_min, t_max)['particle'])
+
+
+def summarize_tracks(points, particles):
+    """ Summarize the tracks of particles from points in time order (as from TrackStore.points) with grouped
+    array operations: the number of points ('count'), the first and last value of each column (e.g. 'x_first',
+    'x_last') and the path length ('path_length'). Particles without points get a count of 0. """
+    particles = np.asarray(particles, dtype=np.int64)
+    # group the points per particle, stable to keep the time order within each particle
+    order = np.argsort(points['particle'], kind='stable')
+    grouped = {name: np.append(col[order], 0) for name, col in points.items()}  # padded, for particles without points
+    ids, first, count = np.unique(grouped['particle'][:-1], return_index=True, return_counts=True)
+    pos = np.minimum(np.searchsorted(ids, particles), len(ids))
+    found = pos < len(ids)
+    found[found] = ids[pos[found]] == particles[found]
+    pos[~found] = len(ids)  # index of the padding
+    first, last = np.append(first, -1), np.append(first + count - 1, -1)
+    summary = {'count': np.append(count, 0)[pos]}
+    for name, col in grouped.items():
+        if name not in ('particle', 't'):
+            summary[f'{name}_first'] = np.where(found, col[first[pos]], np.nan)
+            summary[f'{name}_last'] = np.where(found, col[last[pos]], np.nan)
+    if 'x' in points and 'y' in points:
+        # path length, summing the steps between consecutive points of the same particle
+        p = grouped['particle'][:-1]
+        same = p[1:] == p[:-1]
+        steps = np.sqrt(np.diff(grouped['x'][:-1])**2 + np.diff(grouped['y'][:-1])**2)[same]
+        path_length = np.bincount(np.searchsorted(ids, p[1:][same]), weights=steps, minlength=len(ids) + 1)
+        summary['path_length'] = path_length[pos]
+    return summary
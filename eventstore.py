@@ -0,0 +1,103 @@
+import h5py
+import numpy as np
+
+
+# event columns: name, data type, value if missing
+# timestamps are monotonic-clock timestamps in ns (time.perf_counter_ns), durations in ms
+_timestampColumns = ['frame_timestamp', 'pipeline_start', 'pipeline_end', 'prepause', 'coord_transf_start',
+                     'coord_transf_end', 'scan_initiate', 'scan_end']
+_columns = [
+    ('wall_time', np.float64, np.nan),
+    ('frame_number', np.int64, -1),
+    *[(name, np.int64, -1) for name in _timestampColumns],
+    ('fastscan_x_center', np.float64, np.nan),
+    ('fastscan_y_center', np.float64, np.nan),
+    ('slowscan_x_center', np.float64, np.nan),
+    ('slowscan_y_center', np.float64, np.nan),
+    ('pipeline_rep_period', np.float64, np.nan),
+    ('pipeline_ms', np.float64, np.nan),
+    ('transform_ms', np.float64, np.nan),
+    ('trigger_to_scan_ms', np.float64, np.nan),
+    ('frame_to_scan_ms', np.float64, np.nan),
+    ('scan_ms', np.float64, np.nan),
+    ('frames_dropped', np.int64, -1),
+    ('frames_dropped_busy', np.int64, -1),
+]
+# derived latency columns: name, start timestamp, end timestamp
+_latencyColumns = [
+    ('pipeline_ms', 'pipeline_start', 'pipeline_end'),
+    ('transform_ms', 'coord_transf_start', 'coord_transf_end'),
+    ('trigger_to_scan_ms', 'pipeline_end', 'scan_initiate'),
+    ('frame_to_scan_ms', 'frame_timestamp', 'scan_initiate'),
+    ('scan_ms', 'scan_initiate', 'scan_end'),
+]
+
+
+class EventStore:
+    """ Columnar store of the events detected in a session, with one row per event and typed
+    columns, appended in batches to an 'events' dataset in a HDF5 file per session. The batches
+    are written in the background by a LogWriter. """
+
+    def __init__(self, logWriter, batchSize=10):
+        self.logWriter = logWriter
+        self.batchSize = batchSize
+        self.__filename = None
+        self.__rows = list()
+
+    def newSession(self, filename, pipelinename, paramNames, paramVals):
+        """ Start a new session, stored in a new file. Writes any pending events of the last session. """
+        self.flush()
+        self.__filename = filename
+        self.__attrs = {'pipeline': pipelinename, 'param_names': list(paramNames)}
+        self.__paramVals = np.array(paramVals, dtype=np.float64)
+        self.__dtype = np.dtype([(name, dtype) for name, dtype, _ in _columns] +
+                                [('pipeline', h5py.string_dtype()),
+                                 ('param_vals', np.float64, (len(self.__paramVals),)),
+                                 ('det_coords', h5py.vlen_dtype(np.float64))])
+
+    def addEvent(self, log):
+        """ Add an event from an event log dictionary, with keys named as the columns. Missing
+        columns get a missing value, and the latency columns are derived from the timestamps. """
+        if self.__filename is None:
+            return
+        row = np.zeros(1, dtype=self.__dtype)
+        for name, _, missing in _columns:
+            val = log.get(name)
+            row[name] = missing if val is None else val
+        for name, start, end in _latencyColumns:
+            if row[start][0] >= 0 and row[end][0] >= 0 and name not in log:
+                row[name] = (row[end] - row[start])/1e6
+        row['pipeline'] = self.__attrs['pipeline']
+        row['param_vals'] = self.__paramVals
+        row['det_coords'][0] = np.ravel(np.asarray(log.get('det_coords', []), dtype=np.float64))
+        self.__rows.append(row)
+        if len(self.__rows) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        """ Pass the pending events on to be written in the background. """
+        if self.__rows:
+            rows = np.concatenate(self.__rows)
+            self.logWriter.submit(appendEvents, self.__filename, rows, self.__attrs)
+            self.__rows = list()
+
+
+def appendEvents(filename, rows, attrs):
+    """ Append rows of events to the events dataset in a HDF5 file, creating it if needed. """
+    with h5py.File(filename, 'a') as f:
+        if 'events' not in f:
+            f.create_dataset('events', shape=(0,), maxshape=(None,), dtype=rows.dtype, chunks=(256,))
+            for key, val in attrs.items():
+                f.attrs[key] = val
+        dset = f['events']
+        n = dset.shape[0]
+        dset.resize((n + len(rows),))
+        dset[n:] = rows
+
+
+def loadEvents(filename):
+    """ Load all events of a session, as a structured array with one row per event, together with the session attributes. """
+    with h5py.File(filename, 'r') as f:
+        events = f['events'][()]
+        attrs = dict(f.attrs)
+    return events, attrs
@@ -0,0 +1,144 @@
+import numpy as np
+
+
+class FrameStack(np.ndarray):
+    """ Frames in time order, as returned by FrameBuffer.last(), carrying the summed-area tables
+    of the frames ('integrals', None if not kept), the sequence numbers of the frames ('ids') and
+    the sequence number the next appended frame gets ('next_id'). Arrays derived from a stack do not carry them. """
+
+    def __new__(cls, frames, integrals=None, ids=None, next_id=None):
+        stack = np.asarray(frames).view(cls)
+        stack.integrals = integrals
+        stack.ids = ids
+        stack.next_id = next_id
+        return stack
+
+    def __array_finalize__(self, obj):
+        self.integrals = None
+        self.ids = None
+        self.next_id = None
+
+
+class FrameBuffer:
+    """ Fixed-capacity ring buffer of frames, preallocated as one contiguous array.
+    Every frame is written to two mirrored slots, so that any run of consecutive frames
+    in time order is a contiguous slice of the buffer and can be returned as a read-only
+    view without copying. Indexing is in time order: 0 is the oldest, -1 the newest frame.
+    An allocator with the signature of np.empty can be given to place the buffer elsewhere,
+    e.g. in shared memory. If integral, the summed-area table of every frame is computed once
+    when it is added and kept alongside it in the same way, for box sums in O(1) per window.
+    Every appended frame gets a sequence number, increasing by one per frame over the lifetime of
+    the buffer (also when cleared or reallocated), identifying the frame for caches of the pipelines. """
+
+    def __init__(self, capacity, shape=None, dtype=None, allocator=None, integral=False):
+        self.capacity = int(capacity)
+        self.integral = integral
+        self.__allocator = np.empty if allocator is None else allocator
+        self.__buffer = None
+        self.__integrals = None  # summed-area tables of the frames, with a leading row and column of zeros
+        self.__ids = np.empty(2*self.capacity, dtype=np.int64)  # sequence numbers of the frames
+        self.__next_id = 0  # sequence number of the next appended frame
+        self.__head = 0  # slot of the next frame to be written
+        self.__count = 0  # number of frames currently held
+        if shape is not None:
+            self.allocate(shape, dtype)
+
+    @property
+    def shape(self):
+        """ Shape of a single frame, None if not yet allocated. """
+        return None if self.__buffer is None else self.__buffer.shape[1:]
+
+    @property
+    def dtype(self):
+        """ Data type of the frames, None if not yet allocated. """
+        return None if self.__buffer is None else self.__buffer.dtype
+
+    def allocate(self, shape, dtype):
+        """ Allocate the buffer for frames of the given shape and data type, dropping any held frames. """
+        self.__buffer = self.__allocator((2*self.capacity, *shape), dtype)
+        self.__integrals = None
+        if self.integral:
+            # exact for integer frames
+            integral_dtype = np.int64 if np.issubdtype(dtype, np.integer) else np.float64
+            self.__integrals = self.__allocator((2*self.capacity, shape[0] + 1, shape[1] + 1), integral_dtype)
+            self.__integrals[:, 0, :] = 0
+            self.__integrals[:, :, 0] = 0
+        self.clear()
+
+    def setAllocator(self, allocator=None):
+        """ Set the allocator used for the buffer (np.empty if None). Drops the current buffer. """
+        self.__allocator = np.empty if allocator is None else allocator
+        self.__buffer = None
+        self.__integrals = None
+        self.clear()
+
+    def setIntegral(self, integral):
+        """ Keep the summed-area tables of the frames or not. Drops the current buffer if changed. """
+        if integral != self.integral:
+            self.integral = integral
+            self.__buffer = None
+            self.__integrals = None
+            self.clear()
+
+    def clear(self):
+        """ Drop all held frames, keeping the allocated buffer. """
+        self.__head = 0
+        self.__count = 0
+
+    def append(self, img):
+        """ Copy a new frame into the buffer, overwriting the oldest one if full. The buffer
+        is (re)allocated if the frame shape or data type differs from the current one. """
+        img = np.asarray(img)
+        if self.__buffer is None or img.shape != self.shape or img.dtype != self.dtype:
+            self.allocate(img.shape, img.dtype)
+        self.__buffer[self.__head] = img
+        self.__buffer[self.__head + self.capacity] = img
+        self.__ids[self.__head] = self.__ids[self.__head + self.capacity] = self.__next_id
+        self.__next_id += 1
+        if self.__integrals is not None:
+            integral = self.__integrals[self.__head, 1:, 1:]
+            np.cumsum(img, axis=0, dtype=integral.dtype, out=integral)
+            np.cumsum(integral, axis=1, out=integral)
+            self.__integrals[self.__head + self.capacity] = self.__integrals[self.__head]
+        self.__head = (self.__head + 1) % self.capacity
+        self.__count = min(self.__count + 1, self.capacity)
+
+    def latest(self):
+        """ Return a view of the newest frame. """
+        if self.__count == 0:
+            raise IndexError('FrameBuffer is empty')
+        return self.last(1)[0]
+
+    def last(self, n=None):
+        """ Return a view of the last n frames (all held frames if None) in time order,
+        as a FrameStack of shape (n, *frame shape), carrying the views of their summed-area tables if kept,
+        and their sequence numbers. """
+        if self.__buffer is None:
+            return FrameStack(np.empty((0,)), ids=self.__ids[:0], next_id=self.__next_id)
+        n = self.__count if n is None else max(0, min(int(n), self.__count))
+        end = self.__head + self.capacity
+        frames = self.__buffer[end-n:end]
+        frames.flags.writeable = False
+        integrals = None
+        if self.__integrals is not None:
+            integrals = self.__integrals[end-n:end]
+            integrals.flags.writeable = False
+        return FrameStack(frames, integrals, self.__ids[end-n:end].copy(), self.__next_id)
+
+    def integrals(self, n=None):
+        """ Return a view of the summed-area tables of the last n frames (all held frames if None) in time order,
+        as an array of shape (n, height + 1, width + 1), None if not kept. """
+        return self.last(n).integrals if self.__buffer is not None else None
+
+    def __len__(self):
+        return self.__count
+
+    def __getitem__(self, key):
+        """ Return a view of the frame(s) at an index or slice, in time order. """
+        return self.last()[key]
+
+    def __array__(self, dtype=None, copy=None):
+        frames = np.asarray(self.last())
+        if dtype is not None and dtype != frames.dtype:
+            return frames.astype(dtype)
+        return frames.copy() if copy else frames
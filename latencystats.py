@@ -0,0 +1,74 @@
+import numpy as np
+
+
+class LatencyStats:
+    """ Rolling statistics of the durations of the stages of the frame-to-scan path.
+    Durations are recorded in ns from monotonic-clock (time.perf_counter_ns) timestamps,
+    and the latest window of durations of each stage is kept in a preallocated ring array,
+    from which percentiles and histograms are calculated. """
+
+    def __init__(self, window=1000):
+        self.window = int(window)
+        self.reset()
+
+    def reset(self):
+        """ Drop all recorded durations. """
+        self.__stages = dict()  # stage: [ring array of the latest durations (ns), total number of recorded durations]
+
+    def record(self, stage, duration):
+        """ Record the duration (ns) of one run of a stage. """
+        stats = self.__stages.get(stage)
+        if stats is None:
+            stats = self.__stages[stage] = [np.zeros(self.window, dtype=np.int64), 0]
+        stats[0][stats[1] % self.window] = duration
+        stats[1] += 1
+
+    def stages(self):
+        """ Get the names of all stages with recorded durations. """
+        return list(self.__stages.keys())
+
+    def count(self, stage):
+        """ Get the total number of recorded durations of a stage. """
+        return self.__stages[stage][1] if stage in self.__stages else 0
+
+    def samples(self, stage):
+        """ Get the durations (ns) in the current window of a stage, in no particular order. """
+        if stage not in self.__stages:
+            return np.empty(0, dtype=np.int64)
+        samples, count = self.__stages[stage]
+        return samples[:min(count, self.window)]
+
+    def percentiles(self, stage, q=(50, 95, 99)):
+        """ Get percentiles (ms) of the durations in the current window of a stage. """
+        samples = self.samples(stage)
+        if len(samples) == 0:
+            return [np.nan for _ in q]
+        return list(np.percentile(samples, q)/1e6)
+
+    def histogram(self, stage, bins=50):
+        """ Get a histogram (counts, bin edges in ms) of the durations in the current window of a stage. """
+        return np.histogram(self.samples(stage)/1e6, bins=bins)
+
+    def summary(self):
+        """ Get a summary of all stages: count, mean, p50, p95, p99 and max duration (ms) in the current window. """
+        summary = dict()
+        for stage in self.stages():
+            samples = self.samples(stage)
+            p50, p95, p99 = self.percentiles(stage)
+            summary[stage] = {
+                'count': self.count(stage),
+                'mean_ms': np.mean(samples)/1e6,
+                'p50_ms': p50,
+                'p95_ms': p95,
+                'p99_ms': p99,
+                'max_ms': np.max(samples)/1e6
+            }
+        return summary
+
+    def dumpSummary(self, filename):
+        """ Save the summary of all stages to a text file. """
+        summary = self.summary()
+        with open(filename, 'w') as f:
+            for stage, stats in summary.items():
+                line = ', '.join([f'{key}: {val:.3f}' if isinstance(val, float) else f'{key}: {val}' for key, val in stats.items()])
+                f.write(f'{stage}: {line}\n')
@@ -0,0 +1,109 @@
+import os
+import glob
+import time
+import queue
+import logging
+import threading
+from datetime import datetime
+
+
+class LogWriter:
+    """ Writes logs and messages to files in a background thread, fed through a bounded
+    queue. Files of a session get unique names in constant time, from a session prefix
+    (the start time of the session) and a counter. """
+
+    def __init__(self, logsDir, maxsize=1000):
+        self.logsDir = logsDir
+        self.messagesDropped = 0  # messages dropped due to a full queue
+        self.__queue = queue.Queue(maxsize=maxsize)
+        self.__lock = threading.Lock()
+        self.handler = LogWriterHandler(self)
+        self.newSession()
+        self.__thread = threading.Thread(target=self.run, daemon=True)
+        self.__thread.start()
+
+    def newSession(self):
+        """ Start a new session, with a new prefix for the filenames. """
+        with self.__lock:
+            base = datetime.utcnow().strftime('%Hh%Mm%Ss%fus')
+            prefix = base
+            # only check for existing files once per session, the counter keeps names unique within it
+            n = 1
+            while glob.glob(os.path.join(self.logsDir, prefix) + '_*'):
+                prefix = f'{base}-{n}'
+                n += 1
+            self.__prefix = prefix
+            self.__counter = 0
+
+    def newName(self, suffix):
+        """ Get a new unique filename in the logs folder, ending with suffix. """
+        with self.__lock:
+            name = f'{self.__prefix}_{self.__counter:05d}_{suffix}'
+            self.__counter += 1
+        return os.path.join(self.logsDir, name)
+
+    def submit(self, func, *args):
+        """ Queue a function writing to a file, to be called with args in the background. """
+        self.__queue.put(('call', func, args))
+
+    def writeMessage(self, msg):
+        """ Queue a message to be printed and appended to the messages file of the session. Dropped if the queue is full. """
+        try:
+            self.__queue.put_nowait(('msg', os.path.join(self.logsDir, f'{self.__prefix}_messages.txt'), msg))
+        except queue.Full:
+            self.messagesDropped += 1
+
+    def flush(self):
+        """ Block until all queued logs and messages have been written. """
+        self.__queue.join()
+
+    def run(self):
+        while True:
+            kind, target, content = self.__queue.get()
+            try:
+                os.makedirs(self.logsDir, exist_ok=True)
+                if kind == 'call':
+                    target(*content)
+                elif kind == 'msg':
+                    print(content)
+                    with open(target, 'a') as f:
+                        f.write(f'{content}\n')
+            except Exception as e:
+                print(f'Failed to write log: {e}')
+            finally:
+                self.__queue.task_done()
+
+
+class RateLimitFilter(logging.Filter):
+    """ Logging filter letting the same message from the same logger through at most once
+    per interval (s), and reporting the number of suppressed repeats the next time it passes. """
+
+    def __init__(self, interval=5.0):
+        super().__init__()
+        self.interval = interval
+        self.__last = dict()  # (logger, msg): [time last passed, number suppressed since]
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        last = self.__last.get(key)
+        if last is not None and now - last[0] < self.interval:
+            last[1] += 1
+            return False
+        if last is not None and last[1] > 0:
+            record.msg = f'{record.msg} (repeated {last[1]} times)'
+        self.__last[key] = [now, 0]
+        return True
+
+
+class LogWriterHandler(logging.Handler):
+    """ Logging handler passing rate-limited messages on to a LogWriter. """
+
+    def __init__(self, logWriter, interval=5.0):
+        super().__init__()
+        self.logWriter = logWriter
+        self.addFilter(RateLimitFilter(interval))
+        self.setFormatter(logging.Formatter('%(asctime)s %(name)s: %(message)s'))
+
+    def emit(self, record):
+        self.logWriter.writeMessage(self.format(record))
@@ -1,34 +1,237 @@
+import time
+import functools
+from collections import deque
+
 import numpy as np
-from scipy.stats import multivariate_normal
 from PyQt5.QtCore import QObject, QThread, pyqtSignal, QTimer
 
+from pipelineprocess import basePipelineName
+
+
+# ground-truth events: kind of event model, position (row, col) and frame number the event started at
+eventDtype = np.dtype([('kind', 'U8'), ('row', np.float64), ('col', np.float64), ('start', np.int64)])
+_kinds = ('spike', 'rise', 'fusion')
+
+
+@functools.lru_cache(maxsize=8)
+def psfPatches(sigma, subpixel=4):
+    """ Get Gaussian PSF patches of sigma and peak 1 (float32), centered at a grid of subpixel x subpixel
+    offsets within a pixel, as an array of shape (subpixel, subpixel, patch size, patch size). """
+    radius = int(np.ceil(3*sigma))
+    x = np.arange(-radius, radius + 1)
+    offsets = np.arange(subpixel)/subpixel
+    profiles = np.exp(-(x[None, :] - offsets[:, None])**2/(2*sigma**2))
+    return (profiles[:, None, :, None]*profiles[None, :, None, :]).astype(np.float32)
+
+# scene parameters matching the default parameters of the CPU versions of the provided pipelines, with events of the
+# kind the pipeline detects only (SyntheticScene.preset). The default scene is too faint for the thresholds of
+# dynamin_rise and vesicle_proximity (thresh_abs(_lo)=500 in the difference of Gaussians of the raw frame).
+scenePresets = {
+    'rapid_signal_spikes': dict(background=100, margin=20, spike_rate=0.2, spike_amp=200),
+    'bapta_calcium_spikes': dict(background=100, margin=20, spike_rate=0.2, spike_amp=200),
+    'dynamin_rise': dict(background=100, margin=20, spike_rate=0, rise_rate=0.05, rise_amp=4000, rise_hold=15),
+    'vesicle_proximity': dict(background=100, margin=20, spike_rate=0, fusion_rate=0.05, fusion_amp=4000,
+                              fusion_frames=20, fusion_dist=16, fusion_hold=15)
+}
+
+
+class SyntheticScene:
+    """
+    Synthetic scene seen by a fast imaging camera, fast enough for kHz frame rates of frames of a few hundred
+    pixels: a fixed background and spots stamped from Gaussian PSF patches precomputed at subpixel offsets,
+    with shot noise added in place from a pregenerated noise field at a random offset per frame (or drawn
+    exactly from a Poisson distribution if exact_noise, slower). All randomness comes from one generator seeded
+    with seed, so that a scene can be reproduced. The spots follow event models matching the provided pipelines,
+    each with a Poisson-distributed number of new events per frame of mean <model>_rate, at random positions:
+    - spike: a broad spot appearing at once and decaying exponentially over spike_decay frames (rapid_signal_spikes)
+    - rise: a spot rising linearly in intensity over rise_frames frames and staying for rise_hold frames (dynamin_rise)
+    - fusion: two vesicles fusion_dist apart moving towards each other over fusion_frames frames and fusing into
+      one, staying for fusion_hold frames (vesicle_proximity)
+    Every frame comes with the ground-truth events happening in it (eventDtype): the appearance of a spike, the
+    end of the rise of a rise, and the fusion of two vesicles, at the position of the spot remaining.
+    The default amplitudes are below the default thresholds of the pipelines; preset gives a scene matching them.
+    """
+
+    def __init__(self, shape=(400, 400), seed=None, background=10, exact_noise=False, margin=10,
+                 spike_rate=0.2, spike_amp=60, spike_sigma=7, spike_decay=0,
+                 rise_rate=0, rise_amp=60, rise_sigma=1.5, rise_frames=10, rise_hold=10,
+                 fusion_rate=0, fusion_amp=60, fusion_sigma=1.5, fusion_frames=10, fusion_dist=12, fusion_hold=10,
+                 subpixel=4, noise_pad=64):
+        self.shape = tuple(shape)
+        self.rng = np.random.default_rng(seed)
+        self.exact_noise = exact_noise
+        self.margin = margin
+        self.subpixel = subpixel
+        self.models = {
+            'spike': dict(rate=spike_rate, amp=spike_amp, sigma=spike_sigma, decay=spike_decay),
+            'rise': dict(rate=rise_rate, amp=rise_amp, sigma=rise_sigma, frames=rise_frames, hold=rise_hold),
+            'fusion': dict(rate=fusion_rate, amp=fusion_amp, sigma=fusion_sigma, frames=fusion_frames,
+                           dist=fusion_dist, hold=fusion_hold)
+        }
+        self.background = np.broadcast_to(np.asarray(background, dtype=np.float32), self.shape)
+        self.t = 0  # number of the next frame
+        # spots, one column each: kind index, start frame, start position and velocity (row, col), amplitude,
+        # sigma, frames of movement, lifetime and age of the ground-truth event (-1 for none)
+        self.spots = {name: np.empty(0, dtype=dtype) for name, dtype in
+                      (('kind', np.int64), ('t0', np.int64), ('row', np.float64), ('col', np.float64),
+                       ('vrow', np.float64), ('vcol', np.float64), ('amp', np.float64), ('sigma', np.float64),
+                       ('moving', np.int64), ('lifetime', np.int64), ('truth_age', np.int64))}
+        self.__img = np.empty(self.shape, dtype=np.float32)  # frame being generated
+        self.__scratch = np.empty(self.shape, dtype=np.float32)
+        self.__noise_pad = noise_pad
+        self.__noise = None if exact_noise else self.rng.standard_normal(
+            (self.shape[0] + noise_pad, self.shape[1] + noise_pad), dtype=np.float32)
+
+    @classmethod
+    def preset(cls, pipeline, shape=(400, 400), seed=None, **params):
+        """ Get a scene with the events of a pipeline (name, with or without _cpu) at amplitudes and rates matching its
+        default parameters (scenePresets), with any parameter overridden by params. With the default parameters of
+        the CPU pipelines, over 300 frames at 400x400 (seeds 0-2), the events detected within 6 px and -5 to 15
+        frames of the ground truth are: rapid_signal_spikes 178/179 and bapta_calcium_spikes 178/179 spikes,
+        dynamin_rise 39/44 rises and vesicle_proximity 33/34 fusions, with 1 detection not matching an event. """
+        return cls(shape, seed, **{**scenePresets[basePipelineName(pipeline)], **params})
+
+    def addSpots(self, **columns):
+        """ Add spots, given as columns of equal length (all columns of self.spots). """
+        for name, col in columns.items():
+            self.spots[name] = np.concatenate((self.spots[name], np.broadcast_to(col, np.shape(columns['t0']))))
+
+    def startEvents(self):
+        """ Start the new events of all models in the current frame. """
+        t, rng = self.t, self.rng
+        for kind, model in enumerate(_kinds):
+            params = self.models[model]
+            n = rng.poisson(params['rate']) if params['rate'] > 0 else 0
+            if n == 0:
+                continue
+            pos = rng.uniform(self.margin, np.array(self.shape) - self.margin, (n, 2))
+            amp = rng.uniform(0.5, 1, n)*params['amp']
+            t0 = np.full(n, t)
+            if model == 'spike':
+                lifetime = max(1, int(np.ceil(5*params['decay'])))
+                self.addSpots(kind=kind, t0=t0, row=pos[:, 0], col=pos[:, 1], vrow=0., vcol=0., amp=amp,
+                              sigma=params['sigma'], moving=0, lifetime=lifetime, truth_age=0)
+            elif model == 'rise':
+                self.addSpots(kind=kind, t0=t0, row=pos[:, 0], col=pos[:, 1], vrow=0., vcol=0., amp=amp,
+                              sigma=params['sigma'], moving=0, lifetime=params['frames'] + params['hold'],
+                              truth_age=params['frames'] - 1)
+            else:
+                # two vesicles on opposite sides of the fusion position, meeting there after fusion_frames frames,
+                # the first one staying after the fusion
+                angle = rng.uniform(0, 2*np.pi, n)
+                offset = params['dist']/2*np.column_stack((np.sin(angle), np.cos(angle)))
+                for sign, lifetime, truth_age in ((1, params['frames'] + params['hold'], params['frames']),
+                                                  (-1, params['frames'], -1)):
+                    start = pos + sign*offset
+                    self.addSpots(kind=kind, t0=t0, row=start[:, 0], col=start[:, 1],
+                                  vrow=-sign*offset[:, 0]/params['frames'], vcol=-sign*offset[:, 1]/params['frames'],
+                                  amp=amp, sigma=params['sigma'], moving=params['frames'], lifetime=lifetime,
+                                  truth_age=truth_age)
+
+    def intensities(self, age):
+        """ Get the current intensities of the spots, of the given ages. """
+        spots = self.spots
+        intensity = spots['amp'].copy()
+        spike = spots['kind'] == 0
+        decay = self.models['spike']['decay']
+        intensity[spike] *= np.exp(-age[spike]/decay) if decay > 0 else (age[spike] == 0)
+        rise = spots['kind'] == 1
+        intensity[rise] *= np.minimum(1, (age[rise] + 1)/self.models['rise']['frames'])
+        return intensity
+
+    def stamp(self, img, rows, cols, intensities, sigmas):
+        """ Add PSF patches of the given peak intensities and sigmas at the positions (row, col) to img, in place. """
+        height, width = self.shape
+        for row, col, intensity, sigma in zip(rows, cols, intensities, sigmas):
+            patches = psfPatches(float(sigma), self.subpixel)
+            radius = patches.shape[-1] // 2
+            r, c = int(np.floor(row)), int(np.floor(col))
+            patch = patches[int((row - r)*self.subpixel), int((col - c)*self.subpixel)]
+            r0, r1, c0, c1 = max(r - radius, 0), min(r + radius + 1, height), max(c - radius, 0), min(c + radius + 1, width)
+            if r0 < r1 and c0 < c1:
+                img[r0:r1, c0:c1] += intensity*patch[r0 - r + radius:r1 - r + radius, c0 - c + radius:c1 - c + radius]
+
+    def frame(self):
+        """ Generate the next frame (uint16), and get its ground-truth events (eventDtype). """
+        self.startEvents()
+        spots = self.spots
+        age = self.t - spots['t0']
+        moved = np.minimum(age, spots['moving'])
+        rows, cols = spots['row'] + spots['vrow']*moved, spots['col'] + spots['vcol']*moved
+        # ground truth
+        truth = np.flatnonzero(age == spots['truth_age'])
+        events = np.empty(len(truth), dtype=eventDtype)
+        events['kind'] = np.array(_kinds)[spots['kind'][truth]]
+        events['row'], events['col'], events['start'] = rows[truth], cols[truth], spots['t0'][truth]
+        # background and spots
+        img = self.__img
+        np.copyto(img, self.background)
+        self.stamp(img, rows, cols, self.intensities(age), spots['sigma'])
+        # shot noise
+        if self.exact_noise:
+            img = self.rng.poisson(img).astype(np.float32)
+        else:
+            dy, dx = self.rng.integers(0, self.__noise_pad + 1, 2)
+            noise = self.__noise[dy:dy + self.shape[0], dx:dx + self.shape[1]]
+            scratch = self.__scratch
+            np.sqrt(img, out=scratch)
+            np.multiply(scratch, noise, out=scratch)
+            img += scratch
+            np.maximum(img, 0, out=img)
+        frame = np.empty(self.shape, dtype=np.uint16)
+        np.copyto(frame, img, casting='unsafe')
+        # remove the spots at the end of their lifetime
+        alive = age + 1 < spots['lifetime']
+        if not np.all(alive):
+            self.spots = {name: col[alive] for name, col in spots.items()}
+        self.t += 1
+        return frame, events
+
 
 class MockCamera:
-    def __init__(self):
+    def __init__(self, scene=None):
+        # synthetic scene generating the frames, by default with occasional broad intensity spikes, matching the
+        # default parameters of rapid_signal_spikes_cpu used in the demo
+        self.scene = SyntheticScene.preset('rapid_signal_spikes') if scene is None else scene
         self.properties = {
             'name': 'MockCamera',
-            'image_width': 400,
-            'image_height': 400,
+            'image_width': self.scene.shape[1],
+            'image_height': self.scene.shape[0],
             'update_time': 200
         }
         self._running = False
-        self.imgsize = (self.properties['image_width'], self.properties['image_height'])
-        self.img = np.zeros(self.imgsize)
+        self.imgsize = self.scene.shape
+        self.img = np.zeros(self.imgsize, dtype=np.uint16)
+        self.frameNumber = -1  # sequence number of the latest frame, increases monotonically
+        self.frameTimestamp = time.perf_counter_ns()  # capture timestamp of the latest frame (ns, monotonic clock)
+        self.events = np.empty(0, dtype=eventDtype)  # ground-truth events of the latest frame
+        self.groundTruth = deque(maxlen=10000)  # (frame number, ground-truth events) of the latest frames with events
 
         self.thread = QThread()
         self.worker = FrameWorker(self)
         self.worker.moveToThread(self.thread)
         self.thread.started.connect(self.worker.run)
+        # signal emitting every new frame together with its frame number and capture timestamp
+        self.sigNewFrame = self.worker.newFrame
         self.thread.start()
 
     def getImage(self):
         """ Return latest frame. """
         return self.img
 
+    def getFrame(self):
+        """ Return latest frame, its frame number and its capture timestamp. """
+        return self.img, self.frameNumber, self.frameTimestamp
+
+    def getEvents(self):
+        """ Return the ground-truth events of the latest frame. """
+        return self.events
+
         
 class FrameWorker(QObject):
     started = pyqtSignal()
     finished = pyqtSignal()
+    newFrame = pyqtSignal(object, int, object)  # (img, frame number, capture timestamp (ns))
 
     def __init__(self, camera):
         QThread.__init__(self)
@@ -36,24 +239,23 @@ class FrameWorker(QObject):
         self.camera = camera
 
     def generateFrame(self):
-        """ Generate noisy mock camera image with gaussian spot appearing randomly. """
-        img = np.zeros(self.camera.imgsize)
-        peakmax = 60
-        noisemean = 10
-        freq = 0.8
-        # add a random gaussian peak sometimes
-        if np.random.rand() > freq:
-            x, y = np.meshgrid(np.linspace(0,self.camera.imgsize[1],self.camera.imgsize[1]), np.linspace(0,self.camera.imgsize[0],self.camera.imgsize[0]))
-            pos = np.dstack((x, y))
-            xc = (np.random.rand()*2-1)*self.camera.imgsize[0]/2 + self.camera.imgsize[0]/2
-            yc = (np.random.rand()*2-1)*self.camera.imgsize[1]/2 + self.camera.imgsize[1]/2
-            rv = multivariate_normal([xc, yc], [[50, 0], [0, 50]])
-            img = np.random.rand()*peakmax*317*rv.pdf(pos)
-            img = img + 0.01*np.random.poisson(img)
-        # add Poisson noise
-        img = img + np.random.poisson(lam=noisemean, size=self.camera.imgsize)
+        """ Generate the next frame of the synthetic scene, with its ground-truth events. """
+        img, events = self.camera.scene.frame()
+        self.publishFrame(img, events)
+
+    def publishFrame(self, img, events=None):
+        """ Stamp a new frame with the next frame number and the capture time, and push it to listeners. """
+        timestamp = time.perf_counter_ns()
+        frame_number = self.camera.frameNumber + 1
         self.camera.img = img
+        self.camera.frameTimestamp = timestamp
+        self.camera.frameNumber = frame_number
+        if events is not None:
+            self.camera.events = events
+            if len(events):
+                self.camera.groundTruth.append((frame_number, events))
+        self.newFrame.emit(img, frame_number, timestamp)
 
     def run(self):
         self.timer.timeout.connect(self.generateFrame)
-        self.timer.start(self.camera.properties['update_time'])
\ No newline at end of file
+        self.timer.start(self.camera.properties['update_time'])
@@ -0,0 +1,210 @@
+import sys
+import logging
+import importlib
+import weakref
+import threading
+import traceback
+import collections
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from framebuffer import FrameStack
+from logwriter import RateLimitFilter
+
+
+def basePipelineName(name):
+    """ Get the name of the pipeline (or pipeline module) a CPU version (name ending with _cpu) runs, or name otherwise. """
+    return name[:-len('_cpu')] if name.endswith('_cpu') else name
+
+
+class PipelineProcess:
+    """ Runs an analysis pipeline in a separate worker process. Frames are handed over
+    through shared memory: the current frame is copied into a shared block, and arrays
+    allocated with empty() (e.g. the frame history) are shared directly, so only their
+    location is sent to the worker. The pipeline's exinfo is kept resident in the worker
+    between frames and never sent back. The shared memory block of an array is released (here and in the
+    worker) once the array and all views of it are dropped, e.g. when the frame history is reallocated. """
+
+    def __init__(self, pipelinename, analysisDir):
+        self.pipelinename = pipelinename
+        self.__blocks = dict()  # shared memory blocks allocated by this process and their base addresses, by name
+        self.__released = collections.deque()  # names of released blocks, to be released by the worker as well
+        self.__img = None  # shared array for the current frame
+        self.__mask = None  # binary mask last sent to the worker
+        self.__lock = threading.Lock()  # one request to the worker at a time, as requests come from the GUI and the analysis thread
+        ctx = mp.get_context('spawn')
+        self.__conn, child_conn = ctx.Pipe()
+        self.__process = ctx.Process(target=runPipelineWorker, args=(pipelinename, analysisDir, child_conn),
+                                     daemon=True)
+        self.__process.start()
+
+    def empty(self, shape, dtype):
+        """ Return a new uninitialized array backed by shared memory, that can be passed to the worker without copying. """
+        dtype = np.dtype(dtype)
+        size = max(1, int(np.prod(shape))*dtype.itemsize)
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        self.__blocks[shm.name] = (shm, arr.__array_interface__['data'][0])
+        weakref.finalize(arr, self.__release, shm.name)
+        return arr
+
+    def __release(self, name):
+        """ Release a shared memory block once its array is dropped, and queue it to be released by the worker. """
+        shm, _ = self.__blocks.pop(name, (None, None))
+        if shm is None:
+            return
+        try:
+            shm.close()
+        except BufferError:
+            pass  # still referenced by an array, released once that array is garbage collected
+        shm.unlink()
+        self.__released.append(name)
+
+    def __takeReleased(self):
+        """ Take the names of the blocks released since the last request to the worker. """
+        return [self.__released.popleft() for _ in range(len(self.__released))]
+
+    def describe(self, arr):
+        """ Describe the location of an array in one of the shared memory blocks, None if it is not in any. """
+        if not isinstance(arr, np.ndarray):
+            return None
+        addr = arr.__array_interface__['data'][0]
+        for name, (shm, base) in list(self.__blocks.items()):
+            if base <= addr < base + shm.size or (arr.size == 0 and addr == base):
+                return (name, addr - base, arr.shape, arr.strides, arr.dtype.str)
+        return None
+
+    def reset(self):
+        """ Reset the exinfo kept in the worker, at the start of a new experiment. """
+        self.__request('reset')
+
+    def run(self, img, prev_frames, binary_mask, testmode, param_vals):
+        """ Run the pipeline on a frame in the worker and return the detected coordinates
+        (and the analysis image if in testmode). """
+        img = np.asarray(img)
+        if self.__img is None or self.__img.shape != img.shape or self.__img.dtype != img.dtype:
+            self.__img = self.empty(img.shape, img.dtype)
+        self.__img[...] = img
+        img_desc = self.describe(self.__img)
+        prev_desc = self.describe(prev_frames)
+        if prev_desc is None:
+            # not shared, e.g. an empty history: copy
+            prev_desc = np.asarray(prev_frames)
+        # summed-area tables kept with the frame history, if any
+        integrals = getattr(prev_frames, 'integrals', None)
+        integrals_desc = self.describe(integrals)
+        if integrals_desc is None and integrals is not None:
+            integrals_desc = np.asarray(integrals)
+        # sequence numbers of the frames, if any
+        ids = (getattr(prev_frames, 'ids', None), getattr(prev_frames, 'next_id', None))
+        # send binary mask only when changed
+        mask = binary_mask
+        if binary_mask is self.__mask:
+            mask = 'same'
+        self.__mask = binary_mask
+        res = self.__request('run', img_desc, prev_desc, integrals_desc, ids, mask, testmode, list(param_vals))
+        if testmode:
+            return res[0], res[1]
+        return res[0]
+
+    def close(self):
+        """ Stop the worker process and release the shared memory. """
+        if self.__process.is_alive():
+            with self.__lock:
+                self.__conn.send(('stop', []))
+            self.__process.join(timeout=5)
+        if self.__process.is_alive():
+            self.__process.terminate()
+        self.__img = None
+        for shm, _ in self.__blocks.values():
+            try:
+                shm.close()
+            except BufferError:
+                pass  # still referenced by an array, released once that array is garbage collected
+            shm.unlink()
+        self.__blocks = dict()
+
+    def __request(self, cmd, *args):
+        """ Send a request to the worker and receive its reply, as one round trip. """
+        with self.__lock:
+            self.__conn.send((cmd, self.__takeReleased(), *args))
+            status, *res = self.__conn.recv()
+        if status == 'error':
+            raise RuntimeError(f'Pipeline {self.pipelinename} failed in worker process:\n{res[0]}')
+        return res
+
+
+def runPipelineWorker(pipelinename, analysisDir, conn):
+    """ Worker process loop: load the pipeline and run it on frames as requested,
+    keeping exinfo between frames. """
+    sys.path.append(analysisDir)
+    pipeline = getattr(importlib.import_module(f'{pipelinename}'), f'{pipelinename}')
+    # print messages logged by the pipeline (and the pipeline a CPU version runs) and the shared pipeline tools, rate limited
+    handler = logging.StreamHandler()
+    handler.addFilter(RateLimitFilter())
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)s: %(message)s'))
+    for name in {pipeline.__module__, basePipelineName(pipeline.__module__), 'pipeline_tools'}:
+        pipelineLogger = logging.getLogger(name)
+        pipelineLogger.setLevel(logging.INFO)
+        pipelineLogger.addHandler(handler)
+    blocks = dict()
+    closing = []  # released blocks still referenced by arrays, e.g. in exinfo
+    exinfo = None
+    binary_mask = None
+
+    def attach(desc):
+        if not isinstance(desc, tuple):
+            return desc
+        name, offset, shape, strides, dtype = desc
+        if name not in blocks:
+            blocks[name] = shared_memory.SharedMemory(name=name)
+        return np.ndarray(shape, dtype=np.dtype(dtype), buffer=blocks[name].buf, offset=offset, strides=strides)
+
+    def detach(names):
+        closing.extend(blocks.pop(name) for name in names if name in blocks)
+        for shm in list(closing):
+            try:
+                shm.close()
+                closing.remove(shm)
+            except BufferError:
+                pass
+
+    while True:
+        cmd, released, *args = conn.recv()
+        if cmd == 'stop':
+            break
+        detach(released)
+        try:
+            if cmd == 'reset':
+                exinfo = None
+                conn.send(('ok',))
+            elif cmd == 'run':
+                img_desc, prev_desc, integrals_desc, ids, mask, testmode, param_vals = args
+                img = attach(img_desc)
+                prev_frames = attach(prev_desc)
+                prev_frames.flags.writeable = False
+                integrals = None
+                if integrals_desc is not None:
+                    integrals = attach(integrals_desc)
+                    integrals.flags.writeable = False
+                prev_frames = FrameStack(prev_frames, integrals, *ids)
+                if not (isinstance(mask, str) and mask == 'same'):
+                    binary_mask = mask
+                if testmode:
+                    coords, exinfo, img_ana = pipeline(img, prev_frames, binary_mask, testmode, exinfo, *param_vals)
+                    conn.send(('ok', coords, img_ana))
+                else:
+                    coords, exinfo = pipeline(img, prev_frames, binary_mask, testmode, exinfo, *param_vals)
+                    conn.send(('ok', coords))
+                # drop the arrays in shared memory, so that their blocks can be closed once released
+                img = prev_frames = integrals = None
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    for shm in [*blocks.values(), *closing]:
+        try:
+            shm.close()
+        except BufferError:
+            pass
+    conn.close()
@@ -0,0 +1,205 @@
+import os
+import time
+import threading
+
+import h5py
+import numpy as np
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
+
+
+def openStack(filename, dataset=None):
+    """ Open a recorded stack of frames (T x H x W) in a HDF5 or TIFF file, memory mapped where possible, so that
+    frames are only read from the file when delivered. For HDF5 files, dataset is the path of the frames in the file
+    (the first 3D dataset if None), and timestamps are read from a '<dataset>_timestamps' or 'timestamps' dataset next
+    to it, if any. Chunked or compressed HDF5 datasets are read frame by frame through h5py, and compressed TIFF files
+    are decoded once into a temporary memory map.
+    Returns the frames, the frame timestamps (s, None if not recorded) and the open HDF5 file (None if not needed). """
+    if os.path.splitext(filename)[1].lower() in ('.tif', '.tiff'):
+        import tifffile
+        try:
+            frames = tifffile.memmap(filename, mode='r')
+        except ValueError:
+            frames = tifffile.imread(filename, out='memmap')
+        return (frames[None] if frames.ndim == 2 else frames), None, None
+    file = h5py.File(filename, 'r')
+    if dataset is None:
+        datasets = []
+        file.visititems(lambda name, obj: datasets.append(name) if isinstance(obj, h5py.Dataset) and obj.ndim == 3 else None)
+        if not datasets:
+            file.close()
+            raise ValueError(f'No stack of frames found in {filename}')
+        dataset = datasets[0]
+    dset = file[dataset]
+    timestamps = None
+    group = dset.parent
+    for name in (f'{os.path.basename(dset.name)}_timestamps', 'timestamps'):
+        if name in group and len(group[name]) == len(dset):
+            timestamps = group[name][()]
+            # integer timestamps are monotonic-clock timestamps in ns, as recorded by the widget
+            timestamps = timestamps/1e9 if np.issubdtype(timestamps.dtype, np.integer) else timestamps.astype(np.float64)
+            break
+    offset = dset.id.get_offset()
+    if dset.chunks is None and offset is not None:
+        frames = np.memmap(filename, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+        file.close()
+        return frames, timestamps, None
+    return dset, timestamps, file
+
+
+class ReplayCamera:
+    """ Camera replaying a recorded stack of frames from a HDF5 or TIFF file, used in place of MockCamera
+    to reproduce a session or to find the throughput of a pipeline. The frames are streamed from a memory
+    map by a worker thread, paced either by the recorded frame timestamps (pacing='recorded', at speed
+    times the recorded rate, with frame_period (s) between frames if no timestamps were recorded) or as
+    fast as the analysis consumes them (pacing='max': the next frame is delivered once the last one has
+    been analysed, or after timeout (s) if it is not analysed, e.g. when no experiment is running).
+    The stack is replayed from the start again at the end if loop, otherwise the replay stops. """
+
+    def __init__(self, filename, dataset=None, pacing='recorded', speed=1.0, frame_period=0.2, loop=True, timeout=1.0):
+        self.frames, self.timestamps, self.__file = openStack(filename, dataset)
+        if self.timestamps is None:
+            self.timestamps = np.arange(len(self.frames)) * frame_period
+        self.pacing = pacing
+        self.speed = speed
+        self.loop = loop
+        self.timeout = timeout
+        periods = np.diff(self.timestamps)
+        self.properties = {
+            'name': 'ReplayCamera',
+            'filename': filename,
+            'image_width': self.frames.shape[2],
+            'image_height': self.frames.shape[1],
+            'n_frames': len(self.frames),
+            'update_time': 1e3*np.median(periods) if len(periods) else 1e3*frame_period
+        }
+        self.imgsize = tuple(self.frames.shape[1:])
+        self.img = np.zeros(self.imgsize, dtype=self.frames.dtype)
+        self.frameNumber = -1  # sequence number of the latest frame, increases monotonically, also when looping
+        self.frameTimestamp = time.perf_counter_ns()  # delivery timestamp of the latest frame (ns, monotonic clock)
+        self.framesDelivered = 0  # frames delivered since the last counter reset
+        self.framesAnalysed = 0  # delivered frames analysed since the last counter reset
+
+        self.thread = QThread()
+        self.worker = ReplayWorker(self)
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        # signal emitting every new frame together with its frame number and delivery timestamp
+        self.sigNewFrame = self.worker.newFrame
+        self.thread.start()
+
+    def getImage(self):
+        """ Return latest frame. """
+        return self.img
+
+    def getFrame(self):
+        """ Return latest frame, its frame number and its delivery timestamp. """
+        return self.img, self.frameNumber, self.frameTimestamp
+
+    def seek(self, index):
+        """ Continue the replay from frame index of the stack. """
+        self.worker.seek(index)
+
+    def frameAnalysed(self, frameNumber=None):
+        """ Count a delivered frame as analysed, and deliver the next one if pacing as fast as the analysis. """
+        self.framesAnalysed += 1
+        self.worker.analysed()
+
+    def resetFrameCounters(self):
+        """ Reset the counters of delivered and analysed frames. """
+        self.framesDelivered = 0
+        self.framesAnalysed = 0
+
+    def getFrameCounters(self):
+        """ Get the number of delivered and analysed frames, and the index of the next frame in the stack. """
+        return {
+            'frames_delivered': self.framesDelivered,
+            'frames_analysed': self.framesAnalysed,
+            'frames_not_analysed': self.framesDelivered - self.framesAnalysed,
+            'stack_index': self.worker.index
+        }
+
+    def close(self):
+        """ Stop the replay and close the file. """
+        self.worker.stop()
+        self.thread.quit()
+        self.thread.wait()
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+class ReplayWorker(QObject):
+    started = pyqtSignal()
+    finished = pyqtSignal()
+    newFrame = pyqtSignal(object, int, object)  # (img, frame number, delivery timestamp (ns))
+
+    def __init__(self, camera):
+        QObject.__init__(self)
+        self.camera = camera
+        self.index = 0  # index in the stack of the next frame
+        self.__condition = threading.Condition()
+        self.__running = False
+        self.__waiting = False  # waiting for the last frame to be analysed
+        self.__t_start = None  # (monotonic time (s), recorded timestamp (s)) that the pacing is relative to
+
+    def seek(self, index):
+        """ Continue from frame index of the stack, restarting the pacing. """
+        with self.__condition:
+            self.index = int(index) % len(self.camera.frames)
+            self.__t_start = None
+            self.__waiting = False
+            self.__condition.notify()
+
+    def analysed(self):
+        """ Deliver the next frame if waiting for the last one to be analysed. """
+        with self.__condition:
+            self.__waiting = False
+            self.__condition.notify()
+
+    def stop(self):
+        """ Stop the replay loop. """
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+
+    def wait(self, index):
+        """ Wait until frame index is due, returning False if stopped or if another frame was sought meanwhile. """
+        camera = self.camera
+        with self.__condition:
+            if camera.pacing == 'max':
+                self.__condition.wait_for(lambda: not self.__waiting or not self.__running, timeout=camera.timeout)
+            else:
+                if self.__t_start is None:
+                    self.__t_start = (time.perf_counter(), camera.timestamps[index])
+                t_due = self.__t_start[0] + (camera.timestamps[index] - self.__t_start[1]) / camera.speed
+                while self.__running and self.index == index and time.perf_counter() < t_due:
+                    self.__condition.wait(timeout=t_due - time.perf_counter())
+            return self.__running and self.index == index
+
+    def publishFrame(self, img):
+        """ Stamp a new frame with the next frame number and the delivery time, and push it to listeners. """
+        timestamp = time.perf_counter_ns()
+        frame_number = self.camera.frameNumber + 1
+        self.camera.img = img
+        self.camera.frameTimestamp = timestamp
+        self.camera.frameNumber = frame_number
+        self.camera.framesDelivered += 1
+        self.newFrame.emit(img, frame_number, timestamp)
+
+    def run(self):
+        self.__running = True
+        frames = self.camera.frames
+        while self.__running:
+            index = self.index
+            if not self.wait(index):
+                continue
+            with self.__condition:
+                self.index = index + 1
+                if self.index == len(frames):
+                    self.index = 0
+                    self.__t_start = None
+                    if not self.camera.loop:
+                        self.__running = False
+                self.__waiting = True
+            self.publishFrame(np.asarray(frames[index]))
+        self.finished.emit()
@@ -0,0 +1,60 @@
+import numpy as np
+
+from framebuffer import FrameStack
+
+
+class MaskCrop:
+    """ Crop of frames to the bounding box of a binary mask, extended by a margin on all sides for the halo of
+    the filters of the pipelines (so that the analysis inside the mask is the same as on the whole frame), and
+    rounded outwards to a grid of block pixels, so that small changes of a refreshed mask keep the same crop.
+    Crops are views, and the crop of a frame stack keeps the summed-area tables of the frames, cropped as well
+    (box sums on a crop of a summed-area table are unchanged). Coordinates found in the crop are translated back
+    to the whole frame with translate. """
+
+    def __init__(self, mask, margin, block=16):
+        self.source = mask  # the mask the crop was calculated from
+        self.shape = np.shape(mask)  # shape of the whole frame
+        rows, cols = np.flatnonzero(np.any(mask, axis=1)), np.flatnonzero(np.any(mask, axis=0))
+        if len(rows) == 0:
+            # empty mask: keep the whole frame
+            bounds = [(0, self.shape[0]), (0, self.shape[1])]
+        else:
+            bounds = [(idx[0] - margin, idx[-1] + 1 + margin) for idx in (rows, cols)]
+        self.slices = tuple(slice(int(max(0, start // block * block)), int(min(size, -(-stop // block) * block)))
+                            for (start, stop), size in zip(bounds, self.shape))
+        self.offset = np.array([s.start for s in self.slices])  # (row, col) of the top left corner of the crop
+        self.mask = mask[self.slices]  # cropped mask, kept to pass the same object every frame
+
+    def __eq__(self, other):
+        return isinstance(other, MaskCrop) and self.shape == other.shape and self.slices == other.slices
+
+    @property
+    def fraction(self):
+        """ Fraction of the whole frame inside the crop. """
+        return np.prod([s.stop - s.start for s in self.slices]) / np.prod(self.shape)
+
+    def crop(self, frames):
+        """ Crop a frame, or a stack of frames in time order (with their summed-area tables if kept, and their
+        sequence numbers), to a view. """
+        if np.ndim(frames) < 2:
+            return frames
+        cropped = frames[(..., *self.slices)]
+        if isinstance(frames, FrameStack):
+            integrals = frames.integrals
+            if integrals is not None:
+                rows, cols = self.slices
+                integrals = integrals[..., rows.start:rows.stop + 1, cols.start:cols.stop + 1]
+            cropped = FrameStack(cropped, integrals, frames.ids, frames.next_id)
+        return cropped
+
+    def translate(self, coords):
+        """ Translate (row, col) coordinates in the crop (a single coordinate or N x 2) to the whole frame. """
+        if np.size(coords) == 0:
+            return coords
+        return coords + self.offset
+
+    def uncrop(self, img, fill=0):
+        """ Place a cropped image in a new whole-frame image, filled with fill outside the crop. """
+        full = np.full(self.shape, fill, dtype=np.asarray(img).dtype)
+        full[self.slices] = img
+        return full
@@ -0,0 +1,197 @@
+import os
+import queue
+import threading
+from collections import deque
+
+import h5py
+import numpy as np
+
+
+class FrameStream:
+    """ Chunked and resizable dataset of a continuous stream of frames of one kind, with the frame numbers
+    in a dataset alongside. The datasets grow by grow frames at a time, and are trimmed to the written
+    frames when closed. """
+
+    def __init__(self, group, name, shape, dtype, compression=None, grow=256):
+        self.name = name
+        self.grow = grow
+        self.count = 0  # number of frames written
+        self.frames = group.create_dataset(name, shape=(0, *shape), maxshape=(None, *shape), chunks=(1, *shape),
+                                           dtype=dtype, compression=compression)
+        self.frameNumbers = group.create_dataset(f'{name}_frame_numbers', shape=(0,), maxshape=(None,),
+                                                 chunks=(grow,), dtype=np.int64)
+
+    def matches(self, img):
+        """ Check if a frame has the shape and data type of the stream. """
+        return np.shape(img) == self.frames.shape[1:] and np.asarray(img).dtype == self.frames.dtype
+
+    def write(self, img, frameNumber=None):
+        """ Write a frame at the end of the stream, and return its index in the stream. """
+        if self.count == len(self.frames):
+            self.frames.resize(self.count + self.grow, axis=0)
+            self.frameNumbers.resize(self.count + self.grow, axis=0)
+        self.frames[self.count] = img
+        self.frameNumbers[self.count] = -1 if frameNumber is None else frameNumber
+        self.count += 1
+        return self.count - 1
+
+    def close(self):
+        """ Trim the datasets to the written frames. """
+        self.frames.resize(self.count, axis=0)
+        self.frameNumbers.resize(self.count, axis=0)
+
+
+class StackWriter:
+    """ Saves the fast frames and analysis images of detected events to a HDF5 file per session, in a background
+    thread. Frames are passed by reference through a bounded queue, so that nothing is copied or written on the
+    analysis path. By default only the latest capacity frames of each kind are held in the writer thread, as the
+    pre-trigger ring of the next event, and each event is saved in its own group with one chunked and optionally
+    compressed dataset per kind of frame and their frame numbers. If streaming (opt-in per session, as it writes
+    every frame to disk), every frame is also written as it arrives to a dataset per kind of frame in the 'frames'
+    group, and the datasets of the event groups are virtual datasets mapping their frames in the streams, with the
+    stream indices alongside. Frames and events dropped due to a full queue are reported at the end of a session. """
+
+    def __init__(self, capacity=10, compression=None, maxsize=100):
+        self.capacity = capacity  # number of latest frames of each kind saved with the next event
+        self.compression = compression  # HDF5 compression of the datasets ('gzip', 'lzf' or None)
+        self.framesDropped = 0  # frames dropped due to a full queue
+        self.eventsDropped = 0  # events dropped due to a full queue
+        self.__queue = queue.Queue(maxsize=maxsize)
+        self.__thread = threading.Thread(target=self.run, daemon=True)
+        self.__thread.start()
+
+    def newSession(self, filename, stream=False):
+        """ Start a new session, with events saved to a new file, and every frame streamed to it if stream. """
+        self.__queue.put(('session', filename, stream))
+
+    def addFrame(self, kind, img, frameNumber=None):
+        """ Pass on the latest frame of a kind (e.g. 'raw' or 'ana'). The frame is not copied and should not be modified after. """
+        try:
+            self.__queue.put_nowait(('frame', kind, img, frameNumber))
+        except queue.Full:
+            self.framesDropped += 1
+
+    def saveEvent(self, kinds):
+        """ Save the latest frames of the given kinds as a new event, and drop them from the pre-trigger ring. """
+        try:
+            self.__queue.put_nowait(('event', list(kinds)))
+        except queue.Full:
+            self.eventsDropped += 1
+
+    def endSession(self):
+        """ Close the file of the session, after all frames and events have been written. """
+        self.__queue.put(('close',))
+
+    def flush(self):
+        """ Block until all queued frames and events have been handled. """
+        self.__queue.join()
+
+    def run(self):
+        file = None
+        filename = None
+        stream = False  # if streaming every frame of the session
+        streams = dict()  # kind: FrameStream of the frames of the kind, if streaming
+        ring = dict()  # kind: deque of (frame, frame number), or of (stream, index in stream, frame number) if streaming
+        n_events = 0
+        dropped = (0, 0)  # frames and events dropped before the session
+        while True:
+            cmd, *args = self.__queue.get()
+            try:
+                if cmd == 'frame':
+                    kind, img, frameNumber = args
+                    if filename is None:
+                        continue  # no session
+                    if not stream:
+                        ring_kind = ring.setdefault(kind, deque(maxlen=self.capacity))
+                        if ring_kind and (np.shape(img) != np.shape(ring_kind[-1][0]) or
+                                          np.asarray(img).dtype != np.asarray(ring_kind[-1][0]).dtype):
+                            ring_kind.clear()  # new frame shape or data type: start a new pre-trigger ring
+                        ring_kind.append((img, frameNumber))
+                        continue
+                    if file is None:
+                        file = self.openFile(filename)
+                    stream_kind = streams.get(kind)
+                    if stream_kind is None or not stream_kind.matches(img):
+                        # new frame shape or data type: continue in a new dataset, with a new pre-trigger ring
+                        if stream_kind is not None:
+                            stream_kind.close()
+                        ring.pop(kind, None)
+                        name = kind if kind not in file.require_group('frames') else f'{kind}_{len(file["frames"])}'
+                        stream_kind = streams[kind] = FrameStream(file['frames'], name, np.shape(img),
+                                                                  np.asarray(img).dtype, self.compression)
+                    index = stream_kind.write(img, frameNumber)
+                    ring.setdefault(kind, deque(maxlen=self.capacity)).append((stream_kind, index, frameNumber))
+                elif cmd == 'event':
+                    if filename is None or not any(ring.get(kind) for kind in args[0]):
+                        continue  # no frames
+                    if file is None:
+                        file = self.openFile(filename)
+                    group = file.create_group(f'event_{n_events:05d}')
+                    for kind in args[0]:
+                        if stream:
+                            self.writeEvent(group, kind, ring.get(kind, ()))
+                        else:
+                            self.writeStack(group, kind, ring.get(kind, ()))
+                        if kind in ring:
+                            ring[kind].clear()
+                    file.flush()
+                    n_events += 1
+                elif cmd in ('session', 'close'):
+                    if filename is not None:
+                        self.reportDropped(file, filename, dropped)
+                    if file is not None:
+                        for stream_kind in streams.values():
+                            stream_kind.close()
+                        file.close()
+                    file = None
+                    streams = dict()
+                    ring = dict()
+                    filename = None
+                    if cmd == 'session':
+                        filename, stream = args
+                        n_events = 0
+                        dropped = (self.framesDropped, self.eventsDropped)
+            except Exception as e:
+                print(f'Failed to save frames: {e}')
+            finally:
+                self.__queue.task_done()
+
+    def openFile(self, filename):
+        """ Open the file of a session, creating its folder if needed. """
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        return h5py.File(filename, 'a')
+
+    def reportDropped(self, file, filename, dropped):
+        """ Report the frames and events dropped due to a full queue during a session, and save the numbers in its file. """
+        framesDropped, eventsDropped = self.framesDropped - dropped[0], self.eventsDropped - dropped[1]
+        if file is not None:
+            file.attrs['frames_dropped'] = framesDropped
+            file.attrs['events_dropped'] = eventsDropped
+        if framesDropped or eventsDropped:
+            print(f'Saving frames to {filename} fell behind: dropped {framesDropped} frames and {eventsDropped} events')
+
+    def writeStack(self, group, kind, frames):
+        """ Save frames (frame, frame number) in group, as a chunked dataset written one frame at a time. """
+        if len(frames) == 0:
+            return
+        img = np.asarray(frames[0][0])
+        dset = group.create_dataset(kind, shape=(len(frames), *img.shape), chunks=(1, *img.shape), dtype=img.dtype,
+                                    compression=self.compression)
+        for i, (img, _) in enumerate(frames):
+            dset[i] = img
+        group.create_dataset(f'{kind}_frame_numbers', data=np.array([-1 if n is None else n for _, n in frames],
+                                                                    dtype=np.int64))
+
+    def writeEvent(self, group, kind, frames):
+        """ Save frames (stream, index, frame number) in group, as a virtual dataset of their frames in the streams. """
+        if len(frames) == 0:
+            return
+        dset = frames[0][0].frames
+        layout = h5py.VirtualLayout(shape=(len(frames), *dset.shape[1:]), dtype=dset.dtype)
+        for i, (stream, index, _) in enumerate(frames):
+            layout[i] = h5py.VirtualSource(stream.frames)[index]
+        group.create_virtual_dataset(kind, layout)
+        group.create_dataset(f'{kind}_frame_numbers', data=np.array([-1 if n is None else n for _, _, n in frames],
+                                                                    dtype=np.int64))
+        group.create_dataset(f'{kind}_indices', data=np.array([index for _, index, _ in frames], dtype=np.int64))
+        group.attrs[f'{kind}_stream'] = dset.name
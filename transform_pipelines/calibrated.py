@@ -1,6 +1,7 @@
 def coord_transform(coords_input, params_fit, *args, **kwargs):
     """ General third-order polynomial coordinate transform, characterized by the
-    inputted fitted params.
+    inputted fitted params. Takes the (row, col) coordinates in the fast image, as returned
+    by the detection pipelines and annotated in the calibration.
     """
 
     c1 = coords_input[0]
@@ -1,5 +1,5 @@
 def wf_800_scan_80(coords_input, *args, **kwargs):
-        "Pre-calibrated third-order polynomial coordinate transform for etSTED"
+        "Pre-calibrated third-order polynomial coordinate transform for etSTED, of (row, col) coordinates in the fast image"
         # example fit from "Transform coordinates" subwidget
         params_fit = [-4.867258043104539077e-09,
                         -2.285257544220520152e-09,